@@ -1,12 +1,105 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import collections.abc
+import hashlib
+import math
+import os
+from mutagen import MutagenError
 from mutagen.flac import FLAC, Picture
 from mutagen.id3 import __getattribute__, APIC, PictureType
 from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4, MP4Cover
-import numpy as np
   
 from .set_defaults import *
+from .instrumentation import timer
+from .quick_read import QUICK_READ_SUPPORTED, FullReadRequired, read_flac, read_mp3, read_mp4
+
+
+# Compiled field maps per tag schema/dataframe, keyed by its id().
+# The schema itself is kept alongside, so its id can't be reused by another object
+_FIELDMAP_CACHE = {}
+
+
+def compile_fieldmaps(tagdf=FIELDNAMES):
+
+    """
+    compile_fieldmaps : turns a tag schema (or a tag dataframe, e.g. read from 'fieldnames.csv' with pandas)
+                        into one plain dictionary per file type, so looking up a field name doesn't require
+                        a (slow) pandas lookup. The result is cached, so every AudioWrapper using the same
+                        schema shares the same dictionaries.
+                        N.B.: changes made to a dataframe after it was first compiled are not picked up
+
+    :param tagdf : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                   and human-readable tag names (e.g. 'artist', 'album') as rows.
+                   Each element is the field name to be used for that tag on that
+                   type of file
+
+    :return fieldmaps : (dict) dictionary mapping each file type (e.g. 'MP3') to a dictionary
+                        mapping tag names to field names. Empty cells in 'tagdf' (e.g. 'album art'
+                        for FLAC files) are mapped to None
+    """
+
+    cached = _FIELDMAP_CACHE.get(id(tagdf))
+    if cached is not None and cached[0] is tagdf:
+        return cached[1]
+
+    if isinstance(tagdf, collections.abc.Mapping):
+        # Already one dictionary per file type
+        fieldmaps = {filetype: dict(fieldmap) for filetype, fieldmap in tagdf.items()}
+    else:
+        fieldmaps = {}
+        for filetype in tagdf.columns:
+            fieldmaps[filetype] = {tagname: (field if isinstance(field, str) else None)
+                                   for tagname, field in tagdf[filetype].items()}
+    _FIELDMAP_CACHE[id(tagdf)] = (tagdf, fieldmaps)
+
+    return fieldmaps
+
+
+def tag_names(tagdf=FIELDNAMES):
+
+    """
+    tag_names : gets the human-readable names of all tags in a tag schema (or tag dataframe)
+
+    :param tagdf : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                   and human-readable tag names (e.g. 'artist', 'album') as rows
+
+    :return tagnames : (list) all tag names, in order
+    """
+
+    if isinstance(tagdf, collections.abc.Mapping):
+        return list(tagdf.tagnames) if hasattr(tagdf, 'tagnames') else list(next(iter(tagdf.values()), {}))
+    return list(tagdf.index)
+
+
+def padding_policy(reserve=PADDING_RESERVE, max_padding=None):
+
+    """
+    padding_policy : makes a padding function for mutagen's save methods that avoids rewriting
+                     the whole audio file where possible. If the new tags fit in the existing
+                     padding, that padding is left as is, so only the tags are overwritten in place.
+                     If they don't fit, the file has to be rewritten anyway, and 'reserve' bytes
+                     of padding are added, so later edits will fit in place
+
+    :param reserve     : (int) padding (in bytes) to add when the file has to be rewritten
+    :param max_padding : (int) if the padding left after saving would be larger than this, it is
+                         reduced to 'reserve' (which rewrites the file). If None, existing padding
+                         is never reduced
+
+    :return policy : (function) function taking a mutagen PaddingInfo object and returning the
+                     amount of padding to use
+    """
+
+    def policy(info):
+        if info.padding >= 0 and (max_padding is None or info.padding <= max_padding):
+            return info.padding
+        return reserve
+
+    return policy
+
+
+DEFAULT_PADDING = padding_policy()
 
 
 class AudioWrapper:
@@ -15,31 +108,74 @@ class AudioWrapper:
     AudioWrapper : wrapper class to generalise mutagen's tagging operations across 3 file types (MP3, MP4, FLAC)
     """
         
-    def __init__(self, p, tagdf=FIELDNAMES):
+    def __init__(self, p, tagdf=FIELDNAMES, read_only=False, metrics=None):
         
         """
-        :param p     : (Path) pathlib.Path object of an audio file
-        :param tagdf : (DataFrame) dataframe with the supported file types as columns
-                       and human-readable tag names (e.g. 'artist', 'album') as rows.
-                       Each element is the field name to be used for that tag on that
-                       type of file
+        :param p         : (Path) pathlib.Path object of an audio file
+        :param tagdf     : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                           and human-readable tag names (e.g. 'artist', 'album') as rows.
+                           Each element is the field name to be used for that tag on that
+                           type of file
+        :param read_only : (bool) if True, only the tags and stream info are read from the file,
+                           and embedded pictures (album art) are skipped without being read.
+                           Much faster and lighter on memory for files with large covers, but
+                           the file can't be saved
+        :param metrics   : (Metrics) Metrics object to record the time spent opening, reading and saving
+                           the file in, and to report messages through (see 'instrumentation').
+                           If None, nothing is recorded and messages are printed
         """
         
         self.tagdf = tagdf
         self.p = p
-        if p.suffix == '.mp3':
-            self.mp3obj = MP3(p)
-            self.id3obj = self.mp3obj.tags
-            self.filetype = 'MP3'
-        elif p.suffix == '.m4a':
-            self.mp4obj = MP4(p)
-            self.filetype = 'MP4'
-        elif p.suffix == '.flac':
-            self.flacobj = FLAC(p)
-            self.filetype = 'FLAC'
+        self.read_only = read_only
+        self.metrics = metrics
+        # Whether any tag value was actually changed since the file was opened or last saved
+        self.dirty = False
+        suffix = p.suffix.lower()
+        with timer(metrics, 'open/parse', p):
+            if suffix == '.mp3':
+                self.mp3obj = self._load(p, MP3, read_mp3)
+                self.id3obj = self.mp3obj.tags
+                self.filetype = 'MP3'
+            elif suffix == '.m4a':
+                self.mp4obj = self._load(p, MP4, read_mp4)
+                self.filetype = 'MP4'
+            elif suffix == '.flac':
+                self.flacobj = self._load(p, FLAC, read_flac)
+                self.filetype = 'FLAC'
+            else:
+                self._report('File type not supported: {0}'.format(p), path=p)
+                return
+        if metrics is not None:
+            metrics.count('files opened')
+            metrics.count('file bytes opened', os.path.getsize(p))
+        self.fields = compile_fieldmaps(tagdf)[self.filetype]
+
+
+    def _load(self, p, full_loader, quick_loader):
+
+        # Loads the mutagen object for the file; in read-only mode, try to skip the pictures first.
+        # Files the quick loader can't handle (an unusual layout, or a parse error) are left to mutagen,
+        # which reads the whole file (and raises its usual errors if the file is broken). Any other
+        # error means the quick loader itself is broken, and is raised
+        if self.read_only and QUICK_READ_SUPPORTED:
+            try:
+                return quick_loader(p)
+            except (FullReadRequired, MutagenError):
+                if self.metrics is not None:
+                    self.metrics.count('full read fallbacks')
+
+        return full_loader(p)
+
+
+    def _report(self, message, **details):
+
+        # Reports a message through the Metrics object, if there is one
+        if self.metrics is None:
+            print(message)
         else:
-            print('File type not supported:', str(p))
-            
+            self.metrics.event(message, **details)
+
 
     def get_value(self, tagname):
         
@@ -51,15 +187,40 @@ class AudioWrapper:
         :return val : the tag value
         """
         
-        field = self.tagdf.loc[tagname, self.filetype]
-        
+        with timer(self.metrics, 'tag read', self.p):
+            return self._read_field(self.fields[tagname])
+
+
+    def get_values(self, tags):
+
+        """
+        get_values : gets the values of several tags from the opened file in one call
+
+        :param tags : (list) names of the tags (as they appear in the index of self.tagdf)
+
+        :return vals : (dict) dictionary mapping each tag name to its value
+        """
+
+        fields = self.fields
+        read_field = self._read_field
+
+        with timer(self.metrics, 'tag read', self.p):
+            return {tagname: read_field(fields[tagname]) for tagname in tags}
+
+
+    def _read_field(self, field):
+
+        # Reads the value of a field (the file type-specific field name, e.g. 'TIT2')
+        if field is None:
+            return math.nan
+
         if self.filetype == 'MP3':
             try:
                 val = self.id3obj[field].text[0]
             except TypeError:
                 val = self.id3obj[field].text
             except KeyError:
-                val = np.nan
+                val = math.nan
         elif self.filetype == 'MP4':
             try:
                 if field in ['trkn', 'disk']:
@@ -70,12 +231,12 @@ class AudioWrapper:
                     except TypeError:
                         val = self.mp4obj.tags[field]
             except KeyError:
-                val = np.nan
+                val = math.nan
         elif self.filetype == 'FLAC':
             try:
                 val = self.flacobj[field]
             except KeyError:
-                val = np.nan
+                val = math.nan
         
         if type(val) is list:
             val = val[0]
@@ -91,7 +252,8 @@ class AudioWrapper:
         :param val     : the desired value of the tag
         """
         
-        field = self.tagdf.loc[tagname, self.filetype]
+        field = self.fields[tagname]
+        old_val = self._raw_field(field)
         
         if self.filetype == 'MP3':
             try:
@@ -100,30 +262,94 @@ class AudioWrapper:
                 obj2add = __getattribute__(field)
                 self.id3obj.add(obj2add(text=val))
             except TypeError:
-                print('File {0}: Cannot set value {1} to field {2}'.format(self.p, val, field))
+                self._report('File {0}: Cannot set value {1} to field {2}'.format(self.p, val, field),
+                             path=self.p, value=val, field=field)
         elif self.filetype == 'MP4':
-            self.mp4obj.tags[field] = val
+            # MP4 tags hold lists of values; a single string would be stored (and read back)
+            # as a list of its characters
+            self.mp4obj.tags[field] = val if isinstance(val, list) else [val]
         elif self.filetype == 'FLAC':
             self.flacobj[field] = val
+
+        # Only mark the file as changed if the value is actually different
+        if self._raw_field(field) != old_val:
+            self.dirty = True
+
+
+    def _raw_field(self, field):
+
+        # Gets the stored value(s) of a field in a form that can be compared before and after
+        # setting it: a list of values, or None if the field isn't present in the file
+        if self.filetype == 'MP3':
+            frame = self.id3obj.get(field)
+            return None if frame is None else [str(text) for text in frame.text]
+        elif self.filetype == 'MP4':
+            # (values may be set as a single value rather than a list, but are always read back as a list)
+            vals = self.mp4obj.tags.get(field)
+            if vals is None or isinstance(vals, list):
+                return vals
+            return [vals]
+        elif self.filetype == 'FLAC':
+            return self.flacobj.get(field)
+
+
+    def set_values(self, mapping):
+
+        """
+        set_values : sets the values of several tags in the opened file in one call
+
+        :param mapping : (dict) dictionary mapping tag names (as they appear in the index of
+                         self.tagdf) to the desired values
+        """
+
+        for tagname, val in mapping.items():
+            self.set_value(tagname, val)
     
 
     def add_album_art(self, art_obj):
         
         """
-        add_album_art : write an album cover image to the file
+        add_album_art : write an album cover image to the file (replacing any existing pictures).
+                        If the file already carries exactly this image, nothing is changed
 
         :param art_obj : (AlbumArt) AlbumArt wrapper object 
+
+        :return changed : (bool) whether the pictures in the file were changed
         """
 
+        if self.get_album_art_digests() == [art_obj.digest]:
+            return False
+
         if self.filetype == 'MP3':
             self.id3obj.delall('APIC')
-            self.save()
             self.id3obj.add(art_obj.image)
         elif self.filetype == 'MP4':
             self.mp4obj['covr'] = art_obj.image
         elif self.filetype == 'FLAC':
             self.flacobj.clear_pictures()
             self.flacobj.add_picture(art_obj.image)
+        self.dirty = True
+
+        return True
+
+
+    def get_album_art_digests(self):
+
+        """
+        get_album_art_digests : get a content hash of each picture embedded in the file, to compare
+                                against the 'digest' of an AlbumArt object
+
+        :return digests : (list) SHA-1 hex digest of the image data of each embedded picture
+        """
+
+        if self.filetype == 'MP3':
+            images = [frame.data for frame in self.id3obj.getall('APIC')]
+        elif self.filetype == 'MP4':
+            images = [bytes(cover) for cover in (self.mp4obj.tags or {}).get('covr', [])]
+        elif self.filetype == 'FLAC':
+            images = [picture.data for picture in self.flacobj.pictures]
+
+        return [hashlib.sha1(image).hexdigest() for image in images]
     
 
     def remove_unused_tags(self):
@@ -133,23 +359,26 @@ class AudioWrapper:
                              Use with care
         """
         
-        used_tags = list(self.tagdf[self.filetype])
+        used_tags = [field for field in self.fields.values() if field is not None]
         
         if self.filetype == 'MP3':
             for tag in list(self.id3obj.keys()):
                 if tag not in used_tags:
                     self.id3obj.pop(tag, None)
-                    print('removed tag {0} from file {1}'.format(tag, self.p))
+                    self.dirty = True
+                    self._report('removed tag {0} from file {1}'.format(tag, self.p), path=self.p, tag=tag)
         elif self.filetype == 'MP4':
             for tag in list(self.mp4obj.tags.keys()):
                 if tag not in used_tags:
                     self.mp4obj.tags.pop(tag, None)
-                    print('removed tag {0} from file {1}'.format(tag, self.p))
+                    self.dirty = True
+                    self._report('removed tag {0} from file {1}'.format(tag, self.p), path=self.p, tag=tag)
         elif self.filetype == 'FLAC':
             for tag in list(self.flacobj.keys()):
                 if tag not in used_tags and tag.lower() not in used_tags:
                     self.flacobj.pop(tag, None)
-                    print('removed tag {0} from file {1}'.format(tag, self.p))
+                    self.dirty = True
+                    self._report('removed tag {0} from file {1}'.format(tag, self.p), path=self.p, tag=tag)
 
 
     def get_length(self):
@@ -170,24 +399,52 @@ class AudioWrapper:
         return length
 
 
-    def save(self):
+    def save(self, force=False, padding=DEFAULT_PADDING):
         
         """
-        save : saves the changes made to the file's tags
+        save : saves the changes made to the file's tags. If no tag value was actually changed,
+               the file is left untouched
+
+        :param force   : (bool) if True, write the file even if nothing was changed
+        :param padding : (function) padding policy: function taking a mutagen PaddingInfo object and
+                         returning the amount of padding to leave after the tags (see 'padding_policy').
+                         The default only rewrites the whole file if the tags no longer fit, and then
+                         reserves PADDING_RESERVE bytes. If None, mutagen's default policy is used
+
+        :return saved : (bool) whether the file was written
         """
         
-        if self.filetype == 'MP3':
-            self.id3obj.save(self.p)
-        elif self.filetype == 'MP4':
-            self.mp4obj.save()
-        elif self.filetype == 'FLAC':
+        # Files opened in read-only mode lack their pictures, so saving them would remove those
+        if self.read_only:
+            self._report('File {0} was opened read-only, not saving'.format(self.p), path=self.p)
+            return False
+
+        if self.filetype == 'FLAC':
             keys = list(self.flacobj.keys())
             for key in keys:
                 if not key.islower():
                     self.flacobj[key.lower()] = self.flacobj[key]
-                    print('changed field name {0} to {1} in file {2}'.format(key, key.lower(), self.p))
+                    self._report('changed field name {0} to {1} in file {2}'.format(key, key.lower(), self.p),
+                                 path=self.p, field=key)
                     self.flacobj.pop(key, None)
-            self.flacobj.save()
+                    self.dirty = True
+
+        if not self.dirty and not force:
+            return False
+
+        with timer(self.metrics, 'tag write', self.p):
+            if self.filetype == 'MP3':
+                self.id3obj.save(self.p, padding=padding)
+            elif self.filetype == 'MP4':
+                self.mp4obj.save(padding=padding)
+            elif self.filetype == 'FLAC':
+                self.flacobj.save(padding=padding)
+        self.dirty = False
+        if self.metrics is not None:
+            self.metrics.count('files saved')
+            self.metrics.count('file bytes saved', os.path.getsize(self.p))
+
+        return True
 
 
 class AlbumArt:
@@ -197,30 +454,112 @@ class AlbumArt:
                written to either an MP3, MP4, or FLAC audio file
     """
 
-    def __init__(self, image_path, audio_filetype):
+    def __init__(self, image_path, audio_filetype, data=None):
 
         """
         param image_path     : (Path) pathlib.Path object pointing to the image file
         param audio_filetype : (str) string indicating the type of audio files to prepare
                                the image file for. Must be either 'MP3', 'MP4', or 'FLAC'
+        param data           : (bytes) contents of the image file, if already read.
+                               If None, the image file is read
         """
 
-        if audio_filetype == 'MP3':
+        if data is None:
             with open(image_path, 'rb') as acfile:
-                self.image = APIC(encoding=3,
-                                  mime=MIME_TYPES[image_path.suffix],
-                                  type=3,
-                                  desc=u'Cover',
-                                  data = acfile.read())
+                data = acfile.read()
+        self.data = data
+        # Content hash of the image, to check if a file already carries this exact image
+        self.digest = hashlib.sha1(data).hexdigest()
+
+        if audio_filetype == 'MP3':
+            self.image = APIC(encoding=3,
+                              mime=MIME_TYPES[image_path.suffix],
+                              type=3,
+                              desc=u'Cover',
+                              data = data)
         elif audio_filetype == 'MP4':
-            with open(image_path, 'rb') as acfile:
-                # The conversion to bytes and then to a list is some black magic fuckery
-                # but mutagen requires this for some reason
-                self.image = [bytes(MP4Cover(data=acfile.read(),
-                                             imageformat=MP4_COVERTYPES[image_path.suffix]))]                               
+            # The conversion to bytes and then to a list is some black magic fuckery
+            # but mutagen requires this for some reason
+            self.image = [bytes(MP4Cover(data=data,
+                                         imageformat=MP4_COVERTYPES[image_path.suffix]))]
+            # That conversion copies the image, so keep only the copy (with the same contents)
+            # rather than holding on to two buffers of the same image
+            self.data = self.image[0]
         elif audio_filetype == 'FLAC':
             self.image = Picture()
             self.image.type = PictureType.COVER_FRONT
             self.image.mime = MIME_TYPES[image_path.suffix]
+            self.image.data = data
+
+
+
+class AlbumArtCache:
+
+    """
+    AlbumArtCache : cache of prepared AlbumArt objects, keyed by the content hash of the image and
+                    the audio file type. Albums sharing the same cover (e.g. the discs of a box set)
+                    therefore share the same AlbumArt objects, even if the image files have different
+                    names. Once the total size of the cached images exceeds 'max_bytes', the least
+                    recently used images are evicted
+    """
+
+    def __init__(self, max_bytes=ART_CACHE_BYTES):
+
+        """
+        :param max_bytes : (int) maximum total size (in bytes) of the cached images
+        """
+
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # (digest, audio file type) -> AlbumArt, in order of use (least recently used first)
+        self._arts = collections.OrderedDict()
+        # (image path, size, modification time) -> digest, so unchanged image files don't
+        # even have to be read again to find out their content hash
+        self._digests = {}
+
+
+    def get(self, image_path, audio_filetype):
+
+        """
+        get : gets the AlbumArt object for an image file and audio file type, preparing it
+              only if no identical image has been prepared for that file type yet
+
+        :param image_path     : (Path) pathlib.Path object pointing to the image file
+        :param audio_filetype : (str) either 'MP3', 'MP4', or 'FLAC'
+
+        :return art_obj : (AlbumArt) AlbumArt wrapper object
+        """
+
+        st = os.stat(image_path)
+        file_key = (str(image_path), st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(file_key)
+        data = None
+        if digest is None:
             with open(image_path, 'rb') as acfile:
-                self.image.data = acfile.read()
+                data = acfile.read()
+            digest = hashlib.sha1(data).hexdigest()
+            self._digests[file_key] = digest
+
+        art_obj = self._arts.get((digest, audio_filetype))
+        if art_obj is not None:
+            self._arts.move_to_end((digest, audio_filetype))
+            return art_obj
+
+        # If the same image was already prepared for another file type,
+        # reuse its data rather than reading the image file again
+        if data is None:
+            for filetype in ('MP3', 'MP4', 'FLAC'):
+                other = self._arts.get((digest, filetype))
+                if other is not None:
+                    data = other.data
+                    break
+        art_obj = AlbumArt(image_path, audio_filetype, data=data)
+        self._arts[(digest, audio_filetype)] = art_obj
+        self.total_bytes += len(art_obj.data)
+
+        # Evict the least recently used images (but always keep the one just added)
+        while self.total_bytes > self.max_bytes and len(self._arts) > 1:
+            _, evicted = self._arts.popitem(last=False)
+            self.total_bytes -= len(evicted.data)
+
+        return art_obj
@@ -1,12 +1,146 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
 import pathlib
 
 from .set_defaults import *
-from .base import AudioWrapper, AlbumArt
+from .base import AudioWrapper, AlbumArtCache
+from .discovery import find_music_files
+from .instrumentation import get_metrics
+from .library_index import LibraryIndex
+from .rename_engine import (apply_renames, group_by_folder, plan_renames, report_plan, sanitize_filename,
+                            titlecase_name)
 
 
-def titles2filenames(folder, titlecase=True, titlecase_list=TITLECASE_EN, tagdf=FIELDNAMES):
+def _update_journal(index_path, saved_files):
+
+    # Saving tags in place doesn't change the modification time of a file's folder, so take the folders
+    # of the saved files out of the folder journal, to make sure the next scan checks the files in them
+    if index_path is not None and len(saved_files) > 0:
+        with LibraryIndex(index_path, schema=None) as index:
+            index.remove_dirs({os.path.dirname(os.path.abspath(mf)) for mf in saved_files})
+
+
+def _rename_all(renames, dry_run, undo_path, metrics):
+
+    # Plans all renames in a folder at once, so renames onto each other's names (e.g. swapping the
+    # names of two tracks) work out, and either reports the plan (dry run) or carries it out. Each folder
+    # is done on its own, so a rename that fails only reverts the other renames in its folder
+    ops = {}
+    for folder_renames in group_by_folder(renames):
+        plan = plan_renames(folder_renames)
+        if dry_run:
+            report_plan(plan, metrics)
+        else:
+            plan = apply_renames(plan, undo_path, metrics)
+        ops.update((op.src, op) for op in plan)
+
+    return [ops[src] for src, _ in renames]
+
+
+def _title_filename(mf, title, titlecase, titlecase_list):
+
+    # New path of a music file named after its title
+    # Replace some characters which are forbidden in (Windows) filenames
+    title = sanitize_filename(title)
+    # Replace specific words from 'titlecase_list' (e.g. 'And', 'Or')
+    # with their lower-case counterparts
+    if titlecase:
+        title = titlecase_name(title, titlecase_list)
+    # Generate the full new path
+    newfilename = title + mf.suffix
+
+    return mf.parent / newfilename
+
+
+def _clean_tags(tag_obj, mf, strip_tags, metrics):
+
+    # Cleans up the tags of a single file (see 'batch_cleanup'); nothing is saved yet
+    # If track numbers are in 'x/y' format ('track X out of Y tracks total')
+    # simplify this to 'x'.
+    # E.g. if the track number is '4/9', it simply becomes '4'
+    vals = tag_obj.get_values(['track', 'title'])
+    trkno = vals['track']
+    if type(trkno) is str:
+        if '/' in trkno:
+            tag_obj.set_value('track', trkno.split('/')[0])
+    # Get the title
+    oldtitle = vals['title']
+    # If the title does not match the filename, use the filename
+    # as the new title
+    if oldtitle != mf.stem:
+        tag_obj.set_value('title', mf.stem)
+        metrics.event('set title of file {0} to {1}'.format(mf, mf.stem), path=mf, title=mf.stem)
+    # If specified, strip from the file all tags that don't
+    # explicitly appear in the 'tagdf' column for that file's file type
+    if strip_tags:
+        tag_obj.remove_unused_tags()
+
+
+def ask_album_years(album_folders):
+
+    """
+    ask_album_years : asks the user for the release year of each album (and possibly an extra A/B/C
+                      tag for sorting albums released in the same year)
+
+    :param album_folders : (list) Path objects of the album folders
+
+    :return years : (dict) dictionary mapping each album folder to the string provided, e.g. '1999' or '1999B'
+    """
+
+    years = {}
+    for p in album_folders:
+        inputstr = '\nPlease provide the release year of the album {0}.'.format(p.stem) \
+                 + ' Use A, B, C etc. to sort albums released in the same year;' \
+                 + ' the first 4 characters of the string will be interpreted as the year.\n'
+        years[p] = input(inputstr)
+
+    return years
+
+
+def album_year(years, album_folder):
+
+    """
+    album_year : looks up the year string (e.g. '1999' or '1999B') of an album in a dictionary of years
+
+    :param years        : (dict) dictionary mapping album folders to year strings. Keys can be Path objects
+                          or full paths of the album folders, or just the folder names (when these are unique)
+    :param album_folder : (Path) path of the album folder
+
+    :return year : (str) year string, or None if the album isn't in 'years'
+    """
+
+    for key in (album_folder, str(album_folder), album_folder.name):
+        if key in years:
+            return years[key]
+
+    return None
+
+
+def album_tags(albumtitle, sortstr):
+
+    """
+    album_tags : defines the album, year and sort album tags of an album, based on the album title and
+                 the year string provided (see 'clean_discography')
+
+    :param albumtitle : (str) album title
+    :param sortstr    : (str) year string, e.g. '1999' or '1999B' (the first 4 characters are the year)
+
+    :return tags : (dict) dictionary mapping 'album', 'year' and 'sort album' to their values
+    """
+
+    year = sortstr[:4]
+    sortalbum = sortstr + ' - ' + albumtitle
+
+    return {'album': albumtitle, 'year': year, 'sort album': sortalbum}
+
+
+def titles2filenames(folder, titlecase=True, titlecase_list=TITLECASE_EN, tagdf=FIELDNAMES, dry_run=False,
+                     undo_path=None, progress=None, metrics=None):
 
     """
     titles2filenames : sets the filename to the title for all files in a given folder
@@ -14,45 +148,44 @@ def titles2filenames(folder, titlecase=True, titlecase_list=TITLECASE_EN, tagdf=
     :param folder         : (str) path of the folder
     :oaram titlecase      : (bool) whether or not to correct the title to "title case"
     :param titlecase_list : (tuple) tuple of all the words to make lowercase for title case
-    :param tagdf          : (DataFrame) dataframe with the supported file types as columns
+    :param tagdf          : (TagSchema or DataFrame) tag schema with the supported file types as columns
                             and human-readable tag names (e.g. 'artist', 'album') as rows.
                             Each element is the field name to be used for that tag on that
                             type of file.
+    :param dry_run        : (bool) if True, only report what would be renamed, without renaming anything
+    :param undo_path      : (str) path of an undo journal to record the renames in (see
+                            'rename_engine.undo_renames'). If None, no journal is kept
+    :param progress       : (function) called after each file with the number of files done, the total
+                            number of files and the path of the file, e.g. to update a progress bar
+    :param metrics        : (Metrics) collects the timings and counts of the operation, and decides whether
+                            messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return plan : (list) one RenameOp (old path, new path, status, error) per file (see 'rename_engine')
     """
     
     # Grab all the music files in the specified folder (including subfolders)
+    metrics = get_metrics(metrics, progress)
     p = pathlib.Path(folder)
-    mfs = list(p.rglob('*.mp3')) + list(p.rglob('*.m4a')) + list(p.rglob('*.flac'))
+    with metrics.timer('discovery'):
+        mfs = find_music_files(p, metrics=metrics)
     
-    for mf in mfs:
+    renames = []
+    for i, mf in enumerate(mfs):
         # Get each file's title
-        tag_obj = AudioWrapper(mf, tagdf)
+        tag_obj = AudioWrapper(mf, tagdf, read_only=True, metrics=metrics)
         title = tag_obj.get_value('title')
-        # Replace some characters which are forbidden in (Windows) filenames
-        title = title.replace('?', '')
-        title = title.replace('/', '-')
-        title = title.replace(':', ' -')
-        title = title.replace('"', '\'')
-        # Replace specific words from 'titlecase_list' (e.g. 'And', 'Or')
-        # with their lower-case counterparts
-        if titlecase:
-            for word in titlecase_list:
-                word_padded = ' ' + word + ' '
-                title = title.replace(word_padded, word_padded.lower())
-        # Generate the full new path
-        newfilename = title + mf.suffix
-        newpath = mf.parent / newfilename
-        # Check if the filename already matches the title.
-        # If not, try to set the filename to the generated title string
-        if str(newpath) != str(mf):
-            try:
-                mf.rename(newpath)
-                print('renamed file {0} to {1}'.format(mf, newpath))
-            except (OSError, FileExistsError):
-                print('could not rename file {0} to {1}'.format(mf, newpath))
+        # Generate the full new path from the (cleaned up) title
+        renames.append((mf, _title_filename(mf, title, titlecase, titlecase_list)))
+        metrics.step(i + 1, len(mfs), mf)
+
+    # Rename all files whose filename doesn't match the title yet in one go
+    plan = _rename_all(renames, dry_run, undo_path, metrics)
+    metrics.finish('titles2filenames')
+
+    return plan
     
 
-def batch_cleanup(folder, strip_tags=False, tagdf=FIELDNAMES):
+def batch_cleanup(folder, strip_tags=False, tagdf=FIELDNAMES, index_path=None, progress=None, metrics=None):
     
     """
     batch_cleanup : strips non-whitelisted tags from the files in a given folder and sets
@@ -60,44 +193,48 @@ def batch_cleanup(folder, strip_tags=False, tagdf=FIELDNAMES):
                     
     :param folder     : (str) path of the folder
     :param strip_tags : (bool) whether or not to strip non-whitelisted tags from the files
-    :param tagdf      : (DataFrame) dataframe with the supported file types as columns
+    :param tagdf      : (TagSchema or DataFrame) tag schema with the supported file types as columns
                         and human-readable tag names (e.g. 'artist', 'album') as rows.
                         Each element is the field name to be used for that tag on that
                         type of file. Relevant here mostly because (if 'strip_tags' == True)
                         tag fields not appearing in 'tagdf' will be stripped from all 
                         music files in the folder!
+    :param index_path : (str) path of the library index file used by 'grab_all_music_files'. If given, the
+                        folders of all files saved are removed from its folder journal, so the next
+                        scan picks up the changes
+    :param progress   : (function) called after each file with the number of files done, the total
+                        number of files and the path of the file, e.g. to update a progress bar
+    :param metrics    : (Metrics) collects the timings and counts of the operation, and decides whether
+                        messages are printed (see 'instrumentation'). If None, a new one is used
     """
 
     # Grab all the music files in the specified folder (including subfolders)    
+    metrics = get_metrics(metrics, progress)
     p = pathlib.Path(folder)
-    mfs = list(p.rglob('*.mp3')) + list(p.rglob('*.m4a')) + list(p.rglob('*.flac'))
+    with metrics.timer('discovery'):
+        mfs = find_music_files(p, metrics=metrics)
+    saved_files = []
     
-    for mf in mfs:
+    for i, mf in enumerate(mfs):
         # Make an AudioWrapper object to access file metadata
-        tag_obj = AudioWrapper(mf, tagdf)
-        # If track numbers are in 'x/y' format ('track X out of Y tracks total')
-        # simplify this to 'x'.
-        # E.g. if the track number is '4/9', it simply becomes '4'
-        trkno = tag_obj.get_value('track')
-        if type(trkno) is str:
-            if '/' in trkno:
-                tag_obj.set_value('track', trkno.split('/')[0])
-        # Get the title
-        oldtitle = tag_obj.get_value('title')
-        # If the title does not match the filename, use the filename
-        # as the new title
-        if oldtitle != mf.stem:
-            tag_obj.set_value('title', mf.stem)
-            print('set title of file {0} to {1}'.format(mf, mf.stem))
-        # If specified, strip from the file all tags that don't
-        # explicitly appear in the 'tagdf' column for that file's file type
-        if strip_tags:
-            tag_obj.remove_unused_tags()
+        tag_obj = AudioWrapper(mf, tagdf, metrics=metrics)
+        # Simplify the track number, set the title to the filename and (if specified)
+        # strip the tags not in 'tagdf'
+        _clean_tags(tag_obj, mf, strip_tags, metrics)
         # Save the changes to the file metadata
-        tag_obj.save()
+        # (files where nothing actually changed are not written)
+        if tag_obj.save():
+            saved_files.append(mf)
+        metrics.step(i + 1, len(mfs), mf)
+
+    _update_journal(index_path, saved_files)
+    metrics.event('Saved {0} files, skipped {1} unchanged files'.format(len(saved_files), len(mfs) - len(saved_files)),
+                  saved=len(saved_files), unchanged=len(mfs) - len(saved_files))
+    metrics.finish('batch_cleanup')
   
         
-def strip_phrase(folder, rstrip_phrase, lstrip_phrase=None):
+def strip_phrase(folder, rstrip_phrase, lstrip_phrase=None, dry_run=False, undo_path=None, progress=None,
+                 metrics=None):
 
     """
     strip_phrase : strips a given string from the filenames of all music files in a folder
@@ -105,13 +242,25 @@ def strip_phrase(folder, rstrip_phrase, lstrip_phrase=None):
     :param folder        : (str) path of the folder
     :param rstrip_phrase : (str) phrase to strip from the end of each filename
     :param lstrip_phrase : (str) phrase to strip from the start of each filename
+    :param dry_run       : (bool) if True, only report what would be renamed, without renaming anything
+    :param undo_path     : (str) path of an undo journal to record the renames in (see
+                           'rename_engine.undo_renames'). If None, no journal is kept
+    :param progress      : (function) called after each file with the number of files done, the total
+                           number of files and the path of the file, e.g. to update a progress bar
+    :param metrics       : (Metrics) collects the timings and counts of the operation, and decides whether
+                           messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return plan : (list) one RenameOp (old path, new path, status, error) per file (see 'rename_engine')
     """
 
     # Grab all the music files in the specified folder (including subfolders)
+    metrics = get_metrics(metrics, progress)
     p = pathlib.Path(folder)
-    mfs = list(p.rglob('*.mp3')) + list(p.rglob('*.m4a')) + list(p.rglob('*.flac'))
+    with metrics.timer('discovery'):
+        mfs = find_music_files(p, metrics=metrics)
     
-    for mf in mfs:
+    renames = []
+    for i, mf in enumerate(mfs):
         # Get each file's filename and remove 'rstrip_phrase' from the end of
         # each filename
         oldfilestem = mf.stem
@@ -122,18 +271,18 @@ def strip_phrase(folder, rstrip_phrase, lstrip_phrase=None):
             newfilestem = oldfilestem.removeprefix(lstrip_phrase)
         # Generate the full new path
         newfilename = newfilestem + mf.suffix
-        newpath = mf.parent / newfilename
-        # Check if the new path is actually different from the old one.
-        # If yes, try to rename the file
-        if str(newpath) != str(mf):
-            try:
-                mf.rename(newpath)
-                print('renamed file {0} to {1}'.format(mf, newpath))
-            except (OSError, FileExistsError):
-                print('could not rename file {0} to {1}'.format(mf, newpath))
+        renames.append((mf, mf.parent / newfilename))
+        metrics.step(i + 1, len(mfs), mf)
+
+    # Rename all files whose new path is actually different from the old one in one go
+    plan = _rename_all(renames, dry_run, undo_path, metrics)
+    metrics.finish('strip_phrase')
+
+    return plan
         
         
-def clean_discography(folder, artist_nesting=0, skip_name='Import', tagdf=FIELDNAMES):
+def clean_discography(folder, artist_nesting=0, skip_name='Import', tagdf=FIELDNAMES, index_path=None, years=None,
+                      progress=None, metrics=None):
     
     """
     clean_discography : easily adds years, album tags and album sort tags to 
@@ -150,10 +299,21 @@ def clean_discography(folder, artist_nesting=0, skip_name='Import', tagdf=FIELDN
                             If artist_nesting == 2, the subdirectories of subdirectories of 'folder' will be considered artist
                             folders, etc..
     :param skip_name      : (str) folder name to always skip
-    :param tagdf          : (DataFrame) dataframe with the supported file types as columns
+    :param tagdf          : (TagSchema or DataFrame) tag schema with the supported file types as columns
                             and human-readable tag names (e.g. 'artist', 'album') as rows.
                             Each element is the field name to be used for that tag on that
                             type of file.
+    :param index_path     : (str) path of the library index file used by 'grab_all_music_files'. If given, the
+                            folders of all files saved are removed from its folder journal, so the next
+                            scan picks up the changes
+    :param years          : (dict) release year of each album (see 'album_year'), e.g. {'Exodus': '1977'}.
+                            Use A, B, C etc. to sort albums released in the same year, e.g. '1977B'.
+                            Albums not in 'years' are skipped. If None, the user is asked for the year
+                            of each album instead
+    :param progress       : (function) called after each file with the number of files done, the total
+                            number of files and the path of the file, e.g. to update a progress bar
+    :param metrics        : (Metrics) collects the timings and counts of the operation, and decides whether
+                            messages are printed (see 'instrumentation'). If None, a new one is used
     """
     
     # Get Path objects for all the artist folders, given the nesting level specified
@@ -164,45 +324,99 @@ def clean_discography(folder, artist_nesting=0, skip_name='Import', tagdf=FIELDN
         globstring = '/'.join(['*' for i in range(artist_nesting)])
         artist_folders = [p for p in list(p_top.glob(globstring)) if p.is_dir() and p.stem != skip_name]
 
+    metrics = get_metrics(metrics, progress)
+    saved_files = []
+    n_unchanged = 0
+
     for artist_folder in artist_folders:
         # Get the album folders within each album folder
         dirlist = [p for p in list(artist_folder.glob('*')) if p.is_dir()]
         
-        # Print the list of folders found (so the user can verify the script found the album folders as intended)
-        print('\nFolder:', artist_folder)
-        print('Albums found:')
-        for p in dirlist:
-            print(p.stem)
-            
-        # Ask the user to input year data (and possibly an extra A/B/C tag for sorting) for each album
-        years = {}
-        for p in dirlist:
-            inputstr = '\nPlease provide the release year of the album {0}.'.format(p.stem) \
-                     + ' Use A, B, C etc. to sort albums released in the same year;' \
-                     + ' the first 4 characters of the string will be interpreted as the year.\n'
-            years[p] = input(inputstr)
+        if years is None:
+            # Print the list of folders found (so the user can verify the script found the album folders as intended)
+            print('\nFolder:', artist_folder)
+            print('Albums found:')
+            for p in dirlist:
+                print(p.stem)
+
+            # Ask the user to input year data (and possibly an extra A/B/C tag for sorting) for each album
+            album_years = ask_album_years(dirlist)
+        else:
+            album_years = {p: album_year(years, p) for p in dirlist}
             
         for p in dirlist:
             # For each album, define the album, year, and sort album tags
             # based on the album folder name and the year provided
-            albumtitle = p.stem
-            sortstr = years[p]
-            year = sortstr[:4]
-            sortalbum = sortstr + ' - ' + albumtitle
+            if album_years[p] is None:
+                metrics.event('No year given for album {0}, skipping it'.format(p), level=logging.WARNING, path=p)
+                continue
+            tags = album_tags(p.stem, album_years[p])
+            sortalbum = tags['sort album']
             # Grab all music files in the folder
             # (use rglob, just in case there are 'Disc 1', 'Disc 2', etc. folders within the album folder)
-            mfs = list(p.rglob('*.mp3')) + list(p.rglob('*.m4a')) + list(p.rglob('*.flac'))
+            with metrics.timer('discovery'):
+                mfs = find_music_files(p, metrics=metrics)
             # Set the new tag values to each file
-            for mf in mfs:
-                tag_obj = AudioWrapper(mf, tagdf)
-                tag_obj.set_value('album', albumtitle)
-                tag_obj.set_value('year', year)
-                tag_obj.set_value('sort album', sortalbum)
-                tag_obj.save()
-                print('updated year, album, sort album tags for file {0}: {1}'.format(mf, sortalbum))
+            for i, mf in enumerate(mfs):
+                tag_obj = AudioWrapper(mf, tagdf, metrics=metrics)
+                tag_obj.set_values(tags)
+                # Files whose tags were already correct are not written
+                if tag_obj.save():
+                    saved_files.append(mf)
+                    metrics.event('updated year, album, sort album tags for file {0}: {1}'.format(mf, sortalbum),
+                                  path=mf, sort_album=sortalbum)
+                else:
+                    n_unchanged += 1
+                metrics.step(i + 1, len(mfs), mf)
+
+    _update_journal(index_path, saved_files)
+    metrics.event('Saved {0} files, skipped {1} unchanged files'.format(len(saved_files), n_unchanged),
+                  saved=len(saved_files), unchanged=n_unchanged)
+    metrics.finish('clean_discography')
+
+
+def find_album_cover(folder, image_filetypes=tuple(MIME_TYPES.keys())):
+
+    """
+    find_album_cover : finds the album cover in an album folder, assuming the image is named the same as
+                       the folder, trying all the specified file extensions until one is found
+
+    :param folder          : (Path) path of the album folder
+    :param image_filetypes : (tuple) tuple of image file extensions to look for, in order
+
+    :return albumcover_path : (Path) path of the album cover, or None if there is none
+    """
+
+    albumname = folder.stem
+    for extension in image_filetypes:
+        albumcover_path = folder / (albumname + extension)
+        if albumcover_path.exists():
+            return albumcover_path
+
+    return None
+
 
+# Outcome of writing album art to a single file (or of an album folder without a cover):
+# 'status' is 'written', 'unchanged', 'failed' or 'no cover'; 'error' describes what went wrong
+ArtResult = collections.namedtuple('ArtResult', ['path', 'album', 'status', 'error'])
 
-def batch_add_album_art(folder, album_nesting=0, image_filetypes=tuple(MIME_TYPES.keys())):
+
+def _write_album_art(audiofile, art_obj, albumname, metrics=None):
+
+    # Writes the album art to a single file. Any error only affects this file,
+    # and is returned as part of the result rather than raised
+    try:
+        wrapper = AudioWrapper(audiofile, metrics=metrics)
+        # Files that already carry this exact image are left untouched
+        wrapper.add_album_art(art_obj)
+        status = 'written' if wrapper.save() else 'unchanged'
+        return ArtResult(audiofile, albumname, status, None)
+    except Exception as e:
+        return ArtResult(audiofile, albumname, 'failed', '{0}: {1}'.format(type(e).__name__, e))
+
+
+def batch_add_album_art(folder, album_nesting=0, image_filetypes=tuple(MIME_TYPES.keys()), art_cache=None,
+                        max_workers=None, index_path=None, progress=None, metrics=None):
 
     """
     batch_add_album_art : function to automatically add album art to large numbers of files.
@@ -219,10 +433,26 @@ def batch_add_album_art(folder, album_nesting=0, image_filetypes=tuple(MIME_TYPE
     :param image_filetypes : (tuple) tuple of image file extensions to look for, e.g. ('.jpg', '.jpeg', '.png', '.bmp').
                              In each album folder, the function tries the file types in order, looking first for 
                              <foldername>.jpg, then for <foldername>.jpeg, etc. 
+    :param art_cache       : (AlbumArtCache) cache of prepared album covers, so identical covers (e.g. of the
+                             discs of a box set) are only read and prepared once. If None, a new cache is used
+                             for this run
+    :param max_workers     : (int) number of threads writing files at the same time (writing is mostly waiting
+                             for the disk, so threads work well here). If None or 1, files are written one by one
+    :param index_path      : (str) path of the library index file used by 'grab_all_music_files'. If given, the
+                             folders of all files saved are removed from its folder journal, so the next
+                             scan picks up the changes
+    :param progress        : (function) called after each file with the number of files done, the total
+                             number of files and the path of the file, e.g. to update a progress bar
+    :param metrics         : (Metrics) collects the timings and counts of the operation, and decides whether
+                             messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return results : (list) one ArtResult per music file (path, album name, status, error), plus one per
+                      album folder without a cover. Failures only affect the file in question
     """
 
 
     # Get Path objects for all the album folders, given the nesting level specified
+    metrics = get_metrics(metrics, progress)
     if album_nesting == 0:
         album_folders = [pathlib.Path(folder)]
     else:
@@ -230,56 +460,98 @@ def batch_add_album_art(folder, album_nesting=0, image_filetypes=tuple(MIME_TYPE
         globstring = '/'.join(['*' for i in range(album_nesting)])
         album_folders = [p for p in list(p_top.glob(globstring)) if p.is_dir()]
 
-    # Find the album cover (assuming the file is named the same as the folder),
-    # trying all the specified file extensions until one is found
-    for folder in album_folders:
-        albumname = folder.stem
-        for extension in image_filetypes:
-            albumcover_path = folder / (albumname + extension)
-            if albumcover_path.exists():
-                break
-        else:
-            print('No album cover found for album {0}'.format(albumname))
-            continue
-
-
-        # Grab all music files in the folder
-        # (use rglob, just in case there are 'Disc 1', 'Disc 2', etc. folders within the album folder);
-        # separate them by file type as different file types require different means of applying album art
-        mp3files = list(folder.rglob('*.mp3'))
-        mp4files = list(folder.rglob('*.m4a'))
-        flacfiles = list(folder.rglob('*.flac'))
-
-        art_obj_dict = {}
-
-        # For each type of music file, create an AlbumArt object of the appropriate type
-        # and assign it to the relevant files
-        if len(mp3files) > 0:
-            art4mp3 = AlbumArt(albumcover_path, 'MP3')
-            for mp3file in mp3files:
-                art_obj_dict[mp3file] = art4mp3
-        if len(mp4files) > 0:
-            art4mp4 = AlbumArt(albumcover_path, 'MP4')
-            for mp4file in mp4files:
-                art_obj_dict[mp4file] = art4mp4
-        if len(flacfiles) > 0:
-            art4flac = AlbumArt(albumcover_path, 'FLAC')
-            for flacfile in flacfiles:
-                art_obj_dict[flacfile] = art4flac
-
-        # Write the album art to the audio files
-        try: 
-            for audiofile in art_obj_dict.keys():
-                wrapper = AudioWrapper(audiofile)
-                wrapper.add_album_art(art_obj_dict[audiofile])
-                wrapper.save()
-            print('Wrote album art for album {0}'.format(albumname))
-        # Very high-resolution album covers may be rejected, hence the exception
-        except Exception:
-            print('Cover for album {0} too large to write'.format(albumname))
+    if art_cache is None:
+        art_cache = AlbumArtCache()
+
+    results = []
+    # Write in parallel threads if asked to; the executor is shut down (waiting for all
+    # writes to finish) when leaving the block, even if something goes wrong
+    if max_workers is not None and max_workers > 1:
+        executor_context = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        executor_context = contextlib.nullcontext()
+    pending = collections.deque()
+    with executor_context as executor:
+
+        # Find the album cover (assuming the file is named the same as the folder),
+        # trying all the specified file extensions until one is found
+        for folder in album_folders:
+            albumname = folder.stem
+            albumcover_path = find_album_cover(folder, image_filetypes)
+            if albumcover_path is None:
+                metrics.event('No album cover found for album {0}'.format(albumname), level=logging.WARNING,
+                              path=folder, album=albumname)
+                results.append(ArtResult(folder, albumname, 'no cover', None))
+                continue
+
+
+            # Grab all music files in the folder
+            # (use rglob, just in case there are 'Disc 1', 'Disc 2', etc. folders within the album folder);
+            # separate them by file type as different file types require different means of applying album art
+            with metrics.timer('discovery'):
+                mfs = find_music_files(folder, metrics=metrics)
+            mp3files = [mf for mf in mfs if mf.suffix.lower() == '.mp3']
+            mp4files = [mf for mf in mfs if mf.suffix.lower() == '.m4a']
+            flacfiles = [mf for mf in mfs if mf.suffix.lower() == '.flac']
+
+            art_obj_dict = {}
+
+            # For each type of music file, create an AlbumArt object of the appropriate type
+            # and assign it to the relevant files
+            try:
+                if len(mp3files) > 0:
+                    art4mp3 = art_cache.get(albumcover_path, 'MP3')
+                    for mp3file in mp3files:
+                        art_obj_dict[mp3file] = art4mp3
+                if len(mp4files) > 0:
+                    art4mp4 = art_cache.get(albumcover_path, 'MP4')
+                    for mp4file in mp4files:
+                        art_obj_dict[mp4file] = art4mp4
+                if len(flacfiles) > 0:
+                    art4flac = art_cache.get(albumcover_path, 'FLAC')
+                    for flacfile in flacfiles:
+                        art_obj_dict[flacfile] = art4flac
+            except Exception as e:
+                error = '{0}: {1}'.format(type(e).__name__, e)
+                metrics.event('could not read album cover {0}: {1}'.format(albumcover_path, error), level=logging.WARNING,
+                              path=albumcover_path, error=error)
+                results.extend(ArtResult(mf, albumname, 'failed', error) for mf in mfs)
+                continue
+
+            # Write the album art to the audio files, each file on its own
+            for audiofile, art_obj in art_obj_dict.items():
+                if executor is None:
+                    results.append(_write_album_art(audiofile, art_obj, albumname, metrics))
+                    metrics.step(len(results), None, audiofile)
+                else:
+                    pending.append(executor.submit(_write_album_art, audiofile, art_obj, albumname, metrics))
+                    # Only keep a limited number of writes queued up, so covers evicted
+                    # from the cache don't stay in memory until the very end
+                    while len(pending) > 4 * max_workers:
+                        results.append(pending.popleft().result())
+                        metrics.step(len(results), None, results[-1].path)
+
+        while pending:
+            results.append(pending.popleft().result())
+            metrics.step(len(results), None, results[-1].path)
+
+    _update_journal(index_path, [result.path for result in results if result.status == 'written'])
+
+    # Report the actual errors, and the totals
+    for result in results:
+        if result.status == 'failed':
+            metrics.count('errors')
+            metrics.event('could not write album art to file {0}: {1}'.format(result.path, result.error),
+                          level=logging.WARNING, path=result.path, error=result.error)
+    counts = collections.Counter(result.status for result in results)
+    metrics.event('Wrote album art to {0} files, skipped {1} unchanged files, {2} files failed, {3} albums without cover'.format(
+                  counts['written'], counts['unchanged'], counts['failed'], counts['no cover']), **counts)
+    metrics.finish('batch_add_album_art')
+
+    return results
 
     
-def adopt_filenames(srcfolder, dstfolder, offset=0):
+def adopt_filenames(srcfolder, dstfolder, offset=0, dry_run=False, undo_path=None, progress=None, metrics=None):
 
     """
     adopt_filenames : function to set the filename of each audio file in a folder
@@ -295,6 +567,16 @@ def adopt_filenames(srcfolder, dstfolder, offset=0):
                        if offset = -4, then the name of track 5 from the source folder
                        will be applied to track 1 in the target folder, track 6 to
                        track 2, etc..
+    :param dry_run   : (bool) if True, only report what would be renamed, without renaming anything
+    :param undo_path : (str) path of an undo journal to record the renames in (see
+                       'rename_engine.undo_renames'). If None, no journal is kept
+    :param progress  : (function) called after each file with the number of files done, the total
+                       number of files and the path of the file, e.g. to update a progress bar
+    :param metrics   : (Metrics) collects the timings and counts of the operation, and decides whether
+                       messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return plan : (list) one RenameOp (old path, new path, status, error) per file that has a matching
+                   track in the source folder (see 'rename_engine')
     """
 
     # Get Path objects for both folders
@@ -303,8 +585,10 @@ def adopt_filenames(srcfolder, dstfolder, offset=0):
 
     # Grab all music files in the folder
     # (use rglob, just in case there are 'Disc 1', 'Disc 2', etc. folders within the album folder)
-    src_files = list(src_p.rglob('*.mp3')) + list(src_p.rglob('*.m4a')) + list(src_p.rglob('*.flac'))
-    dst_files = list(dst_p.rglob('*.mp3')) + list(dst_p.rglob('*.m4a')) + list(dst_p.rglob('*.flac'))
+    metrics = get_metrics(metrics, progress)
+    with metrics.timer('discovery'):
+        src_files = find_music_files(src_p, metrics=metrics)
+        dst_files = find_music_files(dst_p, metrics=metrics)
 
     # Make a dictionary mapping track numbers (in the destination folder) to desired filenames
     filename_dict = {}
@@ -313,14 +597,15 @@ def adopt_filenames(srcfolder, dstfolder, offset=0):
     # specified offset into account
     for src_file in src_files:
         filename = src_file.stem
-        src_wrapper = AudioWrapper(src_file)
+        src_wrapper = AudioWrapper(src_file, read_only=True, metrics=metrics)
         src_trkno = int(src_wrapper.get_value('track'))
         filename_dict[src_trkno + offset] = filename
 
     # Given the filled dictionary, check the destination files' track numbers
-    # and attempt to rename them based on the dictionary
-    for dst_file in dst_files:
-        dst_wrapper = AudioWrapper(dst_file)
+    # and plan to rename them based on the dictionary
+    renames = []
+    for i, dst_file in enumerate(dst_files):
+        dst_wrapper = AudioWrapper(dst_file, read_only=True, metrics=metrics)
         dst_suffix = dst_file.suffix
         dst_trkstr = dst_wrapper.get_value('track')
         # Convert the track numbers to integer values,
@@ -331,14 +616,15 @@ def adopt_filenames(srcfolder, dstfolder, offset=0):
             dst_trkno = int(dst_trkstr.split('/')[0])
         else:
             dst_trkno = int(dst_trkstr)
-        # Attempt the renaming operation 
-        # (if the new filename and the existing one aren't identical)
+        # Generate the new path
         if dst_trkno in filename_dict.keys():
             newfilename = filename_dict[dst_trkno] + dst_suffix
-            newpath = dst_file.parent / newfilename
-            if str(newpath) != str(dst_file):
-                try:
-                    dst_file.rename(newpath)
-                    print('renamed file {0} to {1}'.format(dst_file, newpath))
-                except (OSError, FileExistsError):
-                    print('could not rename file {0} to {1}'.format(dst_file, newpath))
\ No newline at end of file
+            renames.append((dst_file, dst_file.parent / newfilename))
+        metrics.step(i + 1, len(dst_files), dst_file)
+
+    # Rename all files in one go (files may well take each other's names here, e.g. when the
+    # target folder is in a different order)
+    plan = _rename_all(renames, dry_run, undo_path, metrics)
+    metrics.finish('adopt_filenames')
+
+    return plan
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import pathlib
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from mutagen.flac import FLAC
+import mutagen.id3
+from mutagen.mp4 import MP4
+
+from .set_defaults import *
+from .base import AudioWrapper, AlbumArtCache, compile_fieldmaps, tag_names
+from .discovery import find_music_files
+from .instrumentation import Metrics
+
+try:
+    # Not available on Windows; peak memory use is simply not reported there
+    import resource
+except ImportError:
+    resource = None
+
+
+# Modules that make the package slow to import, and should only be imported by the modules that need them
+HEAVY_MODULES = ('pandas', 'numpy', 'matplotlib')
+
+# Modules that should import without any of the heavy modules
+LIGHT_MODULES = ('boogie_manager.base', 'boogie_manager.batch_ops', 'boogie_manager.qobuz_quirks',
+                 'boogie_manager.cue2audacity')
+
+
+def import_time(module, repeat=3):
+
+    """
+    import_time : measures how long it takes to import a module in a fresh Python interpreter, and which
+                  of the heavy modules (pandas, numpy, matplotlib) get imported along with it
+
+    :param module : (str) full name of the module, e.g. 'boogie_manager.batch_ops'
+    :param repeat : (int) number of fresh interpreters to time the import in; the fastest time is kept
+
+    :return seconds : (float) fastest import time in seconds
+    :return heavy   : (list) heavy modules imported along with the module
+    """
+
+    script = ('import sys, time\n'
+              'start = time.perf_counter()\n'
+              'import {0}\n'
+              'print(time.perf_counter() - start)\n'
+              'print(",".join(m for m in {1!r} if m in sys.modules))').format(module, HEAVY_MODULES)
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        seconds, heavy = output.splitlines()
+        times.append(float(seconds))
+
+    return min(times), [m for m in heavy.split(',') if m]
+
+
+def benchmark_imports(modules=LIGHT_MODULES, repeat=3):
+
+    """
+    benchmark_imports : times the import of each module (see 'import_time') and checks that none of them
+                        pulls in pandas, numpy or matplotlib
+
+    :param modules : (tuple) full names of the modules to import
+    :param repeat  : (int) number of fresh interpreters to time each import in
+
+    :return results : (dict) dictionary mapping each module to its fastest import time in seconds
+    """
+
+    results = {}
+    for module in modules:
+        seconds, heavy = import_time(module, repeat)
+        results[module] = seconds
+        print('{0}: {1:.3f} s'.format(module, seconds))
+        if heavy:
+            raise AssertionError('{0} imports {1}'.format(module, ', '.join(heavy)))
+
+    return results
+
+
+
+# Minimal valid audio files: a few seconds of silent MPEG frames / FLAC stream / MP4 atoms.
+# Not playable in any meaningful way, but mutagen reads and writes their tags and stream info
+# just like those of real files
+
+def _mp3_bytes(seconds):
+
+    # MPEG-1 layer III frames at 128 kbps / 44.1 kHz (417 bytes, 1152 samples each)
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * 413
+    return frame * max(int(seconds * 44100 / 1152), 2)
+
+
+def _flac_bytes(seconds):
+
+    # STREAMINFO block (44.1 kHz, stereo, 16 bits) followed by a stub of audio data
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    streaminfo += ((44100 << 44) | (1 << 41) | (15 << 36) | (44100 * seconds)).to_bytes(8, 'big') + b'\x00' * 16
+    return b'fLaC' + bytes([0x80]) + len(streaminfo).to_bytes(3, 'big') + streaminfo + b'\xff\xf8' + b'\x00' * 100
+
+
+def _atom(name, data):
+    return struct.pack('>I', 8 + len(data)) + name + data
+
+
+def _m4a_bytes(seconds):
+
+    # 'ftyp', and a 'moov' atom with the movie and (audio) track headers needed for the stream info
+    ftyp = _atom(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom')
+    mvhd = _atom(b'mvhd', b'\x00' * 12 + struct.pack('>II', 1000, seconds * 1000) + b'\x00' * 80)
+    mdhd = _atom(b'mdhd', b'\x00' * 12 + struct.pack('>II', 44100, seconds * 44100) + b'\x00' * 4)
+    hdlr = _atom(b'hdlr', b'\x00' * 8 + b'soun' + b'\x00' * 13)
+    moov = _atom(b'moov', mvhd + _atom(b'trak', _atom(b'mdia', mdhd + hdlr)))
+    return ftyp + moov + _atom(b'mdat', b'\x00' * 64)
+
+
+def _jpeg_bytes(size, rng):
+
+    # Start and end markers of a JPEG file, with random filler of the requested size in between
+    return b'\xff\xd8\xff\xe0' + bytes(rng.getrandbits(8) for _ in range(max(size - 6, 0))) + b'\xff\xd9'
+
+
+def make_synthetic_file(p, tags, seconds=3, art_obj=None, tagdf=FIELDNAMES):
+
+    """
+    make_synthetic_file : writes a minimal valid MP3, M4A or FLAC file, and sets its tags through
+                          AudioWrapper, i.e. according to the tag schema
+
+    :param p       : (Path) pathlib.Path object of the file to write; the extension sets the file type
+    :param tags    : (dict) dictionary mapping tag names (as they appear in 'tagdf') to values
+    :param seconds : (int) length of the file in seconds
+    :param art_obj : (AlbumArt) album cover to embed. If None, no cover is embedded
+    :param tagdf   : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                     and human-readable tag names (e.g. 'artist', 'album') as rows
+    """
+
+    suffix = p.suffix.lower()
+    p.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write the audio data, with an empty tag container for AudioWrapper to fill in
+    if suffix == '.mp3':
+        p.write_bytes(_mp3_bytes(seconds))
+        # AudioWrapper can only set frames with a description or language (e.g. 'COMM::eng',
+        # 'TXXX:ranking') if they already exist, so add those frames here already
+        id3obj = mutagen.id3.ID3()
+        fieldmap = compile_fieldmaps(tagdf)['MP3']
+        for tagname in tags:
+            parts = fieldmap[tagname].split(':')
+            if len(parts) > 1:
+                frame_args = {'encoding': 3, 'desc': parts[1], 'text': [tags[tagname]]}
+                if len(parts) > 2:
+                    frame_args['lang'] = parts[2]
+                id3obj.add(getattr(mutagen.id3, parts[0])(**frame_args))
+        id3obj.save(p)
+    elif suffix == '.m4a':
+        p.write_bytes(_m4a_bytes(seconds))
+        mp4obj = MP4(p)
+        mp4obj.add_tags()
+        mp4obj.save()
+    elif suffix == '.flac':
+        p.write_bytes(_flac_bytes(seconds))
+        flacobj = FLAC(p)
+        flacobj.add_tags()
+        flacobj.save()
+    else:
+        raise ValueError('File type not supported: {0}'.format(p))
+
+    tag_obj = AudioWrapper(p, tagdf)
+    if tag_obj.filetype == 'MP4':
+        # MP4 files store track and disc numbers as (number, total) pairs rather than 'x/y' strings
+        # (with a total of 0 if there is none)
+        tags = {tagname: ([tuple(int(n) for n in (val + '/0').split('/')[:2])]
+                          if tag_obj.fields[tagname] in ('trkn', 'disk') else val) for tagname, val in tags.items()}
+    tag_obj.set_values(tags)
+    if art_obj is not None:
+        tag_obj.add_album_art(art_obj)
+    tag_obj.save()
+
+
+def make_synthetic_library(root, n_artists=20, albums_per_artist=3, tracks_per_album=10, discs_per_album=1,
+                           genre_depth=2, n_genres=4, cover_bytes=200 * 1024, embed_covers=False,
+                           file_types=('.mp3', '.m4a', '.flac'), seed=0, tagdf=FIELDNAMES):
+
+    """
+    make_synthetic_library : generates a synthetic music library, laid out like the author's library:
+                             <root>/<genre folders>/<artist>/<album>/[Disc N/]<track>. The same arguments
+                             always give the same library (file names, tags and covers)
+
+    :param root              : (str) folder to create the library in (must not exist yet, or be empty)
+    :param n_artists         : (int) number of artists
+    :param albums_per_artist : (int) number of albums per artist
+    :param tracks_per_album  : (int) number of tracks per disc
+    :param discs_per_album   : (int) number of discs per album. If more than 1, each disc gets a 'Disc N'
+                               folder within the album folder
+    :param genre_depth       : (int) number of genre folder levels (1 to 3), e.g. 2 for '01 metal/02 doom'.
+                               Genre tags have the same number of levels, e.g. '01.02 doom'
+    :param n_genres          : (int) number of different genres at each genre level
+    :param cover_bytes       : (int) size of the album cover images (saved in each album folder as
+                               <album>.jpg, as expected by 'batch_add_album_art'). If 0, no covers are made
+    :param embed_covers      : (bool) whether to also embed the covers in the audio files
+    :param file_types        : (tuple) file extensions to use; the tracks of each album cycle through them
+    :param seed              : (int) seed for the random choices (genres, years, sources, cover contents)
+    :param tagdf             : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                               and human-readable tag names (e.g. 'artist', 'album') as rows
+
+    :return n_files : (int) number of audio files created
+    """
+
+    rng = random.Random(seed)
+    root = pathlib.Path(root)
+    sources = sorted(SOURCEDICT.keys())
+    art_cache = AlbumArtCache()
+    filetypes = {'.mp3': 'MP3', '.m4a': 'MP4', '.flac': 'FLAC'}
+
+    n_files = 0
+    for artist_no in range(n_artists):
+        # Each artist gets a single genre (so the library passes 'check_genre_placement');
+        # folder names at each level start with the genre tag for that level
+        levels = ['{0:02d}'.format(rng.randrange(n_genres) + 1) for _ in range(genre_depth)]
+        genre_folder = root.joinpath(*['{0} genre {1}'.format(level, '.'.join(levels[:i + 1]))
+                                       for i, level in enumerate(levels)])
+        genre = '.'.join(levels) + ' genre'
+        artist = 'Artist {0:04d}'.format(artist_no)
+
+        for album_no in range(albums_per_artist):
+            album = 'Album {0:02d}'.format(album_no)
+            album_folder = genre_folder / artist / album
+            year = str(rng.randrange(1950, 2025))
+            source = rng.choice(sources)
+
+            art_objs = {}
+            if cover_bytes > 0:
+                cover_path = album_folder / (album + '.jpg')
+                album_folder.mkdir(parents=True, exist_ok=True)
+                cover_path.write_bytes(_jpeg_bytes(cover_bytes, rng))
+                if embed_covers:
+                    art_objs = {suffix: art_cache.get(cover_path, filetypes[suffix]) for suffix in file_types}
+
+            for disc_no in range(1, discs_per_album + 1):
+                disc_folder = album_folder / 'Disc {0}'.format(disc_no) if discs_per_album > 1 else album_folder
+                for track_no in range(1, tracks_per_album + 1):
+                    suffix = file_types[(track_no - 1) % len(file_types)]
+                    title = 'Song {0} of {1}'.format(track_no, album)
+                    tags = {'title': title, 'artist': artist, 'album artist': artist, 'album': album,
+                            'year': year, 'genre': genre, 'comment': source,
+                            'track': '{0}/{1}'.format(track_no, tracks_per_album),
+                            'disc': '{0}/{1}'.format(disc_no, discs_per_album)}
+                    # File names don't match the titles, so 'batch_cleanup' has work to do
+                    p = disc_folder / '{0:02d} {1}{2}'.format(track_no, title, suffix)
+                    make_synthetic_file(p, tags, art_obj=art_objs.get(suffix), tagdf=tagdf)
+                    n_files += 1
+
+    return n_files
+
+
+def peak_rss():
+
+    """
+    peak_rss : gets the peak memory use (resident set size) of the current process so far
+
+    :return peak : (int) peak memory use in bytes (None if it can't be determined on this system)
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux, but in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_benchmarks(results_path=None, workdir=None, repeat=1, **library_args):
+
+    """
+    run_benchmarks : generates a synthetic library (see 'make_synthetic_library') and times each phase of
+                     scanning and processing it: discovery, parsing, building the dataframe,
+                     'add_derived_cols', 'check_genre_placement', and tag writes ('batch_cleanup' and
+                     'batch_add_album_art')
+
+    :param results_path : (str) path of a JSON lines file to append the results to, so runs can be compared
+                          later (see 'compare_results'). If None, the results are not stored
+    :param workdir      : (str) folder to generate the library in. If None, a temporary folder is used
+                          (and removed afterwards)
+    :param repeat       : (int) number of times to time each read-only phase; the fastest time is kept
+    :param library_args : keyword arguments for 'make_synthetic_library'
+
+    :return results : (dict) dictionary with the library settings, and per phase the time taken (seconds),
+                      the throughput (files per second) and the peak memory use of the whole process up to
+                      the end of that phase (bytes). The latter never goes down, so it is not the memory
+                      use of that phase itself
+    """
+
+    # Imported here, so the import time benchmark above doesn't depend on pandas being installed
+    from . import batch_ops, library_data
+
+    tmpdir = tempfile.mkdtemp() if workdir is None else None
+    root = pathlib.Path(workdir if workdir is not None else tmpdir) / 'library'
+    phases = {}
+
+    def record(name, seconds, n_files):
+        phases[name] = {'seconds': seconds, 'files_per_second': n_files / seconds if seconds > 0 else None,
+                        'process_peak_rss': peak_rss()}
+        print('{0:<24} {1:8.3f} s {2:10.0f} files/s'.format(name, seconds, n_files / seconds if seconds > 0 else 0))
+
+    def timed(name, func, n_files, repeat=1):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+        record(name, min(times), n_files)
+        return result
+
+    try:
+        start = time.perf_counter()
+        n_files = make_synthetic_library(root, **library_args)
+        record('generate', time.perf_counter() - start, n_files)
+
+        alltags = tag_names(FIELDNAMES)
+        alltags.remove('album art')
+        mfs = timed('discovery', lambda: find_music_files(root), n_files, repeat)
+        records = timed('parsing', lambda: library_data.read_file_records(mfs, alltags), n_files, repeat)
+        relpaths = [mf.relative_to(root) for mf in mfs]
+        df = timed('dataframe', lambda: library_data.build_library_frame(relpaths, records, alltags), n_files, repeat)
+        df_extended = timed('add_derived_cols', lambda: library_data.add_derived_cols(df), n_files, repeat)
+        timed('check_genre_placement', lambda: library_data.check_genre_placement(df_extended, rootfolder=root),
+              n_files, repeat)
+        # Quiet, so printing a message per file isn't part of the timings
+        timed('grab_all_music_files', lambda: library_data.grab_all_music_files(root, require_numeric=False,
+                                                                                metrics=Metrics(quiet=True)),
+              n_files, repeat)
+
+        # Tag writes change the library, so they're only timed once
+        timed('batch_cleanup', lambda: batch_ops.batch_cleanup(root, metrics=Metrics(quiet=True)), n_files)
+        album_nesting = library_args.get('genre_depth', 2) + 2
+        timed('batch_add_album_art', lambda: batch_ops.batch_add_album_art(root, album_nesting=album_nesting,
+                                                                           metrics=Metrics(quiet=True)),
+              n_files)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    results = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'n_files': n_files,
+               'library': library_args,
+               'phases': phases}
+    if results_path is not None:
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+
+    return results
+
+
+def compare_results(results_path, baseline=-2, current=-1):
+
+    """
+    compare_results : compares two benchmark runs stored by 'run_benchmarks', phase by phase
+
+    :param results_path : (str) path of the JSON lines file with the results
+    :param baseline     : (int) position of the baseline run in the file (default: the second to last run)
+    :param current      : (int) position of the run to compare (default: the last run)
+
+    :return ratios : (dict) dictionary mapping each phase to the ratio of the current time to the baseline
+                     time (above 1 means the current run was slower)
+    """
+
+    with open(results_path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    old, new = runs[baseline], runs[current]
+    if old['library'] != new['library'] or old['n_files'] != new['n_files']:
+        print('N.B.: the runs used different synthetic libraries')
+
+    ratios = {}
+    for phase, timing in new['phases'].items():
+        if phase in old['phases'] and old['phases'][phase]['seconds'] > 0:
+            ratios[phase] = timing['seconds'] / old['phases'][phase]['seconds']
+            print('{0:<24} {1:8.3f} s -> {2:8.3f} s ({3:+.0%})'.format(phase, old['phases'][phase]['seconds'],
+                                                                    timing['seconds'], ratios[phase] - 1))
+
+    return ratios
+
+
+if __name__ == '__main__':
+    benchmark_imports()
+    run_benchmarks(results_path='benchmark_results.jsonl')
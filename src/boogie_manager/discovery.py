@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import pathlib
+
+from .set_defaults import *
+from .instrumentation import report
+
+
+def scan_files(folder, extensions=tuple(FILETYPES.keys()), metrics=None):
+
+    """
+    scan_files : walks a folder (including subfolders) once and yields every file with one of
+                 the given extensions. Extensions are matched case-insensitively, so e.g.
+                 'Track.MP3' is found as well as 'Track.mp3'
+
+    :param folder     : (str) path of the folder
+    :param extensions : (tuple) file extensions to look for (lower case, including the dot)
+    :param metrics    : (Metrics) Metrics object to report unreadable folders through (see 'instrumentation').
+                        If None, they are printed
+
+    :return entries : (generator) os.DirEntry object for each file found. Its 'stat()' method
+                      gives the file's size and modification time (for free on Windows; on other
+                      systems it is only looked up when asked for, and then cached)
+    """
+
+    extensions = tuple(ext.lower() for ext in extensions)
+
+    # Walk the tree depth-first with an explicit stack of folders still to visit,
+    # listing each folder exactly once
+    stack = [os.fspath(folder)]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in extensions:
+                        yield entry
+        except (PermissionError, FileNotFoundError):
+            report(metrics, 'could not read folder {0}'.format(dirpath), logging.WARNING, path=dirpath)
+
+
+def walk_folders_bottom_up(folder, max_depth, metrics=None):
+
+    """
+    walk_folders_bottom_up : walks a folder once and yields each folder (down to a given depth) with the
+                             names of its subfolders, deepest folders first: a folder is only yielded
+                             after all of its subfolders. Subfolders can therefore be renamed as each folder
+                             comes up, without invalidating the folders still to come
+
+    :param folder    : (str) path of the folder
+    :param max_depth : (int) deepest level of subfolders to list. If max_depth == 1, only 'folder' itself
+                       is yielded, with its direct subfolders; if max_depth == 2, the direct subfolders
+                       are yielded as well (with their subfolders, before 'folder'), etc.
+    :param metrics   : (Metrics) Metrics object to report unreadable folders through (see 'instrumentation').
+                       If None, they are printed
+
+    :return folders : (generator) (path, list of subfolder names) tuple for each folder
+    """
+
+    # Depth-first, with an explicit stack: a folder is put back on the stack (with its subfolders)
+    # after listing it, and only yielded when it comes up again, i.e. once its subfolders are done
+    stack = [(os.fspath(folder), 0, None)]
+    while stack:
+        dirpath, depth, subdirs = stack.pop()
+        if subdirs is not None:
+            yield dirpath, subdirs
+            continue
+        try:
+            with os.scandir(dirpath) as it:
+                subdirs = [entry.name for entry in it if entry.is_dir(follow_symlinks=False)]
+        except (PermissionError, FileNotFoundError):
+            report(metrics, 'could not read folder {0}'.format(dirpath), logging.WARNING, path=dirpath)
+            continue
+        stack.append((dirpath, depth, subdirs))
+        if depth + 1 < max_depth:
+            stack.extend((os.path.join(dirpath, name), depth + 1, None) for name in subdirs)
+
+
+def find_music_files(folder, extensions=tuple(FILETYPES.keys()), metrics=None):
+
+    """
+    find_music_files : gets all music files (MP3/MP4/FLAC) in a folder (including subfolders)
+                       in a single pass over the directory tree
+
+    :param folder     : (str) path of the folder
+    :param extensions : (tuple) file extensions to look for (lower case, including the dot)
+    :param metrics    : (Metrics) Metrics object to report unreadable folders through (see 'instrumentation').
+                        If None, they are printed
+
+    :return mfs : (list) pathlib.Path object for each music file found
+    """
+
+    return [pathlib.Path(entry.path) for entry in scan_files(folder, extensions, metrics)]
+
+
+def scan_changed_files(folder, journal, extensions=tuple(FILETYPES.keys()), metrics=None):
+
+    """
+    scan_changed_files : walks a folder like 'scan_files', but only lists the subfolders whose modification
+                         time changed since they were recorded in the journal. Adding, removing or renaming
+                         a file (or subfolder) changes the modification time of the folder it's in, so the
+                         files of an unchanged folder are taken from the journal, at the cost of a single
+                         stat of the folder.
+                         N.B.: editing a file in place (e.g. saving new tags) does NOT change the modification
+                         time of its folder. Tools that edit files in place should remove the folder from the
+                         journal afterwards (see 'LibraryIndex.remove_dirs'), so it's listed again next time
+
+    :param folder     : (str) path of the folder
+    :param journal    : (dict) dictionary mapping (absolute) folder paths to (mtime, number of entries, subfolder names,
+                        music file names) tuples, as recorded by an earlier scan (see 'LibraryIndex.dirs')
+    :param extensions : (tuple) file extensions to look for (lower case, including the dot)
+    :param metrics    : (Metrics) Metrics object to report unreadable folders through (see 'instrumentation').
+                        If None, they are printed
+
+    :return files     : (list) (path (str), entry) tuple for each music file, in the same order as 'scan_files'
+                        would find them. 'entry' is the os.DirEntry object of a file in a new or changed folder,
+                        or None for a file in an unchanged folder
+    :return updates   : (dict) new journal entries for the folders that were listed
+    :return visited   : (set) paths of all folders found
+    """
+
+    extensions = tuple(ext.lower() for ext in extensions)
+    files = []
+    updates = {}
+    visited = set()
+
+    stack = [os.path.abspath(folder)]
+    while stack:
+        dirpath = stack.pop()
+        # Get the modification time BEFORE listing the folder, so a change made while listing it
+        # is picked up on the next scan
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except (PermissionError, FileNotFoundError):
+            report(metrics, 'could not read folder {0}'.format(dirpath), logging.WARNING, path=dirpath)
+            continue
+        visited.add(dirpath)
+
+        known = journal.get(dirpath)
+        if known is not None and known[0] == mtime:
+            subdirs, filenames = known[2], known[3]
+            files.extend((os.path.join(dirpath, filename), None) for filename in filenames)
+        else:
+            subdirs = []
+            filenames = []
+            n_entries = 0
+            try:
+                with os.scandir(dirpath) as it:
+                    for entry in it:
+                        n_entries += 1
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif os.path.splitext(entry.name)[1].lower() in extensions:
+                            filenames.append(entry.name)
+                            files.append((entry.path, entry))
+            except (PermissionError, FileNotFoundError):
+                report(metrics, 'could not read folder {0}'.format(dirpath), logging.WARNING, path=dirpath)
+                continue
+            updates[dirpath] = (mtime, n_entries, tuple(subdirs), tuple(filenames))
+
+        stack.extend(os.path.join(dirpath, subdir) for subdir in subdirs)
+
+    return files, updates, visited
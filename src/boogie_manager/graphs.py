@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
+import logging
+import os
+import time
+
 import matplotlib.pyplot as plt
 import pandas as pd
 
+from .set_defaults import *
+from .instrumentation import report
+
 
 def pie_chart(df, col_name, save_path=None, label_mapper=None, title=None):
 
@@ -11,7 +19,8 @@ def pie_chart(df, col_name, save_path=None, label_mapper=None, title=None):
                 which percentage of the total collection (in terms of playing time) 
                 is accounted for by each unique value in that column
 
-    :input df           : (DataFrame) the dataframe with music data
+    :input df           : (DataFrame) the dataframe with music data, or a length cube made from it
+                          by 'library_data.build_length_cube'
     :input col_name     : (str) the column to graph
     :input save_path    : (str) file path to save the generated image; must end in .png.
                           If None, the image is not saved to disk
@@ -19,9 +28,11 @@ def pie_chart(df, col_name, save_path=None, label_mapper=None, title=None):
                           graph legend. If None, the values themselves are used as labels
     :input title        : (str) title to put on the graph legend. If None, the column name
                           itself is used as a title
+
+    :return fig : (Figure) the Matplotlib figure
     """
 
-    gb4pie = df[[col_name, 'length']].groupby(col_name)
+    gb4pie = df[[col_name, 'length']].groupby(col_name, observed=True)
     sums4pie = gb4pie.sum()['length']
     if label_mapper is not None:
         new_index = [label_mapper[idx] for idx in sums4pie.index]
@@ -38,6 +49,8 @@ def pie_chart(df, col_name, save_path=None, label_mapper=None, title=None):
     if save_path is not None:
         fig.savefig(save_path, dpi=120, format='png', bbox_inches='tight')
 
+    return fig
+
 
 def graph_vs_year(df, col_name, save_path=None, label_mapper=None, title=None):
 
@@ -48,7 +61,8 @@ def graph_vs_year(df, col_name, save_path=None, label_mapper=None, title=None):
                     is in the collection from each year. Each year's bar is subdivided by the 
                     values in the selected column (e.g. genre)
 
-    :input df           : (DataFrame) the dataframe with music data
+    :input df           : (DataFrame) the dataframe with music data, or a length cube made from it
+                          by 'library_data.build_length_cube'
     :input col_name     : (str) the column to graph, other than 'year'
     :input save_path    : (str) file path to save the generated image; must end in .png.
                           If None, the image is not saved to disk
@@ -56,34 +70,36 @@ def graph_vs_year(df, col_name, save_path=None, label_mapper=None, title=None):
                           graph legend. If None, the values themselves are used as labels
     :input title        : (str) title to put on the graph legend. If None, the column name
                           itself is used as a title
+
+    :return fig : (Figure) the Matplotlib figure
     """
 
-    # Convert the year tags (stored as strings) to integers so Matplotlib understands to
-    # plot them as a series of numbers
-    df['year'] = df['year'].astype(str).astype(int)
+    # Convert the year tags to integers so Matplotlib understands to plot them as a series
+    # of numbers, and the lengths to hours (in a new dataframe, leaving the input untouched).
+    # Files without a (valid) year tag are left out
+    df4graph = pd.DataFrame({'year': pd.to_numeric(df['year'].astype(str), errors='coerce'),
+                             'value': df[col_name],
+                             'hours': df['length'].astype(float) / 3600.0}).dropna(subset=['year'])
+    df4graph['year'] = df4graph['year'].astype(int)
 
-    startyear = min(df['year'])
-    endyear = max(df['year'])
+    startyear = df4graph['year'].min()
+    endyear = df4graph['year'].max()
     years = list(range(startyear, endyear + 1))
     year_ticks = [year for year in years if year % 10 == 0]
 
-    gb_main = df[['year', col_name, 'length']].groupby(['year', col_name])
-    sums_main = gb_main.sum()['length']
-    groupdf_main = pd.DataFrame(index=years, columns=sorted(list(set(df[col_name]))))
-    for year in years:
-        for value in groupdf_main.columns:
-            if (year, value) in gb_main.groups:
-                groupdf_main.loc[year, value] = sums_main.loc[(year, value)] / 3600.0
-            else:
-                groupdf_main.loc[year, value] = 0.0
+    # Total hours for each year (rows) and value (columns), with zeros for missing combinations
+    groupdf_main = df4graph.pivot_table(index='year', columns='value', values='hours', aggfunc='sum',
+                                        fill_value=0.0, observed=True)
+    groupdf_main = groupdf_main.reindex(index=years, fill_value=0.0).sort_index(axis=1)
+    groupdf_main.columns = list(groupdf_main.columns)
+
+    # Stack the bars: each value's bars start on top of the values before it
+    bottoms = groupdf_main.cumsum(axis=1).shift(1, axis=1, fill_value=0.0)
 
     fig, ax = plt.subplots()
-    bottomlist = [0 for i in range(len(groupdf_main))]
     bars = []
     for value in groupdf_main.columns:
-        bars.append(ax.bar(groupdf_main.index, groupdf_main[value], bottom=bottomlist))
-        for i in range(len(groupdf_main)):
-            bottomlist[i] += groupdf_main[value].iloc[i]
+        bars.append(ax.bar(groupdf_main.index, groupdf_main[value], bottom=bottoms[value]))
     fig.set_size_inches(16, 9)
     if label_mapper is not None:
         new_columns = [label_mapper[idx] for idx in groupdf_main.columns]
@@ -102,24 +118,29 @@ def graph_vs_year(df, col_name, save_path=None, label_mapper=None, title=None):
     if save_path is not None:
         fig.savefig(save_path, dpi=120, format='png', bbox_inches='tight')
 
+    return fig
+
 
 def top_x(df, col_name, cutoff=25, save_path=None):
 
     """
     top_x : makes a bar graph of the most occurring values in one column of a dataframe
 
-    :input df           : (DataFrame) the dataframe with music data
+    :input df           : (DataFrame) the dataframe with music data, or a length cube made from it
+                          by 'library_data.build_length_cube'
     :input col_name     : (str) the column to graph
     :input cutoff       : (int) the number of values to plot
     :input save_path    : (str) file path to save the generated image; must end in .png.
                           If None, the image is not saved to disk
+
+    :return fig : (Figure) the Matplotlib figure
     """
 
-    gb = df[[col_name, 'length']].groupby(col_name)
+    gb = df[[col_name, 'length']].groupby(col_name, observed=True)
     sums = gb.sum()['length'].copy() / 3600
     sums.sort_values(inplace=True, ascending=False)
     fig, ax = plt.subplots()
-    sums[:cutoff].plot.bar(ax)
+    sums[:cutoff].plot.bar(ax=ax)
     ax.set_xlabel('')
     ax.set_ylabel('Music (hours)')
     # Adjust the bar label font size to the number of bars
@@ -129,3 +150,110 @@ def top_x(df, col_name, cutoff=25, save_path=None):
     if save_path is not None:
         fig.savefig(save_path, dpi=120, format='png', bbox_inches='tight')
 
+    return fig
+
+
+# Chart types that can be used in the specs passed to 'render_report'
+CHART_FUNCTIONS = {'pie_chart': pie_chart,
+                   'graph_vs_year': graph_vs_year,
+                   'top_x': top_x}
+
+# Data shared by the charts of a report, set once in each worker process
+_REPORT_DATA = None
+
+
+def _init_report_worker(df):
+
+    # Render without a display, and keep the data for all charts this worker renders
+    global _REPORT_DATA
+    plt.switch_backend('Agg')
+    _REPORT_DATA = df
+
+
+def _render_chart(spec):
+
+    # Renders a single chart spec, and closes its figure once it's saved so memory doesn't build up.
+    # Errors are returned instead of raised, so one broken chart doesn't stop the rest of the report
+    start = time.perf_counter()
+    kwargs = {key: val for key, val in spec.items() if key not in ('chart', 'filters')}
+    try:
+        df = _REPORT_DATA
+        for col, values in spec.get('filters', {}).items():
+            if isinstance(values, (list, tuple, set)):
+                df = df[df[col].isin(values)]
+            else:
+                df = df[df[col] == values]
+        if len(df) == 0:
+            raise ValueError('no data left after applying the filters')
+        fig = CHART_FUNCTIONS[spec['chart']](df, **kwargs)
+        plt.close(fig)
+        error = None
+    except Exception as e:
+        plt.close('all')
+        error = repr(e)
+
+    return time.perf_counter() - start, error
+
+
+def render_report(df, specs, max_workers=None, metrics=None):
+
+    """
+    render_report : renders a batch of charts to image files, in parallel and without a display
+                    (Matplotlib's Agg backend). Each figure is closed after it has been saved
+
+    :input df          : (DataFrame) the dataframe with music data, or (preferably, as it is much smaller
+                         to send to the worker processes) a length cube made from it by
+                         'library_data.build_length_cube'
+    :input specs       : (list) one dictionary per chart, with the chart type under 'chart' (one of the keys
+                         of CHART_FUNCTIONS), optionally a dictionary of 'filters' (column -> value or list of
+                         values to keep) and the keyword arguments for the chart function, e.g.
+                         {'chart': 'pie_chart', 'col_name': 'source', 'save_path': 'sources.png'}
+    :input max_workers : (int) number of worker processes. If None, the number of processors is used
+    :input metrics     : (Metrics) Metrics object to report the results through (see 'instrumentation').
+                         If None, they are printed
+
+    :return df_timings : (DataFrame) dataframe with one row per spec (in the same order), with columns 'chart',
+                         'save_path', 'seconds' (time taken to render and save the chart) and 'error' (missing if
+                         the chart was rendered successfully)
+    """
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_report_worker,
+                                                initargs=(df,)) as executor:
+        results = list(executor.map(_render_chart, specs))
+
+    df_timings = pd.DataFrame({'chart': [spec['chart'] for spec in specs],
+                               'save_path': [spec.get('save_path') for spec in specs],
+                               'seconds': [seconds for seconds, _ in results],
+                               'error': [error for _, error in results]})
+
+    failed = df_timings['error'].notna().sum()
+    report(metrics, 'Rendered {0} charts in {1:.1f} seconds ({2} failed)'.format(len(specs) - failed,
+                                                                               time.perf_counter() - start, failed),
+           rendered=int(len(specs) - failed), failed=int(failed))
+    for row in df_timings[df_timings['error'].notna()].itertuples():
+        report(metrics, 'Could not render {0}: {1}'.format(row.save_path, row.error), logging.WARNING,
+               path=row.save_path, error=row.error)
+
+    return df_timings
+
+
+def main_genre_year_specs(save_folder, main_genres=MAINGENRES4YEARS, col_name='genre level 2'):
+
+    """
+    main_genre_year_specs : makes the chart specs for a year graph of each main genre (genre level 1),
+                            to pass to 'render_report'
+
+    :input save_folder : (str) folder to save the images in
+    :input main_genres : (dict) dictionary mapping the main genre tags to their names
+    :input col_name    : (str) the column to subdivide each year's bar by
+
+    :return specs : (list) one chart spec per main genre
+    """
+
+    return [{'chart': 'graph_vs_year',
+             'filters': {'genre level 1': genre_tag},
+             'col_name': col_name,
+             'title': genre_name,
+             'save_path': os.path.join(save_folder, 'year_{0}.png'.format(genre_tag))}
+            for genre_tag, genre_name in main_genres.items()]
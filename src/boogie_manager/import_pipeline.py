@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+import pathlib
+
+from .set_defaults import *
+from .base import AudioWrapper, AlbumArtCache
+from .batch_ops import (_clean_tags, _title_filename, _update_journal, album_tags, album_year, ask_album_years,
+                        find_album_cover)
+from .discovery import scan_files, walk_folders_bottom_up
+from .instrumentation import get_metrics
+from .qobuz_quirks import QOBUZ_IMAGE_TYPES, clean_image_files, folder_renames
+from .rename_engine import apply_renames, group_by_folder, plan_renames
+
+
+# The steps of importing a new download, in the order they are run. Each corresponds to one of the
+# separate batch operations:
+# 'folders'     : clean up the folder names (qobuz_quirks.clean_folders)
+# 'images'      : remove Qobuz's png files and rename the jpg files (qobuz_quirks.clean_album_art)
+# 'cleanup'     : simplify track numbers, set the titles to the filenames and optionally strip
+#                 unused tags (batch_ops.batch_cleanup)
+# 'discography' : set the album, year and sort album tags (batch_ops.clean_discography)
+# 'cover'       : embed the album cover (batch_ops.batch_add_album_art)
+# 'filenames'   : rename the files after their titles (batch_ops.titles2filenames)
+STAGES = ('folders', 'images', 'cleanup', 'discography', 'cover', 'filenames')
+
+# Outcome of importing a single music file: 'path' is where it ended up, 'status' is 'saved',
+# 'unchanged' or 'failed'; 'error' describes what went wrong
+ImportResult = collections.namedtuple('ImportResult', ['original_path', 'path', 'status', 'error'])
+
+
+def _album_folder(mf, root, album_nesting):
+
+    # The album folder a music file belongs to (files in 'Disc 1', 'Disc 2' etc. folders belong to
+    # the album folder above them), or None if the file isn't deep enough to be in an album folder
+    parts = mf.relative_to(root).parts[:-1]
+    if len(parts) < album_nesting:
+        return None
+
+    return root.joinpath(*parts[:album_nesting])
+
+
+def import_download(folder, stages=STAGES, years=None, album_nesting=1, max_nesting=6, strip_tags=False,
+                    titlecase=True, titlecase_list=TITLECASE_EN, image_filetypes=tuple(MIME_TYPES.keys()),
+                    art_cache=None, tagdf=FIELDNAMES, index_path=None, undo_path=None, progress=None, metrics=None):
+
+    """
+    import_download : imports a new download in one go: runs the selected stages (see STAGES) over a
+                      single pass over the files, opening and saving each music file only once, with
+                      all tag changes and the album cover applied together. Replaces running
+                      'clean_folders', 'clean_album_art', 'batch_cleanup', 'clean_discography',
+                      'batch_add_album_art' and 'titles2filenames' one after the other
+
+    :param folder          : (str) path of the download
+    :param stages          : (tuple) stages to run (see STAGES), e.g. ('cleanup', 'cover') to only
+                             clean up the tags and add the album covers. Always run in the order of STAGES
+    :param years           : (dict) release year of each album (see 'batch_ops.album_year'), e.g.
+                             {'Exodus': '1977'}, to use instead of asking for them. Use the folder names as
+                             they are after the 'folders' stage. Albums not in 'years' don't get their album,
+                             year and sort album tags set. If None, the user is asked for the year of each
+                             album found
+    :param album_nesting   : (int) level of nesting within the folder where the album folders are.
+                             If album_nesting == 0, 'folder' itself is the album folder.
+                             If album_nesting == 1, the direct subdirectories of 'folder' are album folders.
+                             If album_nesting == 2, the subdirectories of subdirectories of 'folder' are album
+                             folders, etc.. Music files further down (e.g. in 'Disc 1' folders) belong to the
+                             album folder above them
+    :param max_nesting     : (int) deepest nesting level of folders to clean up the names of
+    :param strip_tags      : (bool) whether or not to strip non-whitelisted tags from the files
+    :oaram titlecase       : (bool) whether or not to correct folder names and filenames to "title case"
+    :param titlecase_list  : (tuple) tuple of all the words to make lowercase for title case
+    :param image_filetypes : (tuple) tuple of image file extensions to look for the album cover with, in order
+                             (see 'batch_ops.find_album_cover')
+    :param art_cache       : (AlbumArtCache) cache of prepared album covers. If None, a new cache is used
+                             for this run
+    :param tagdf           : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                             and human-readable tag names (e.g. 'artist', 'album') as rows.
+                             Each element is the field name to be used for that tag on that
+                             type of file
+    :param index_path      : (str) path of the library index file used by 'grab_all_music_files'. If given, the
+                             folders of all files saved are removed from its folder journal, so the next
+                             scan picks up the changes
+    :param undo_path       : (str) path of an undo journal to record the folder and file renames in (see
+                             'rename_engine.undo_renames'). If None, no journal is kept
+    :param progress        : (function) called after each file of each stage with the number of files done,
+                             the total number of files and the path of the file, e.g. to update a progress bar
+    :param metrics         : (Metrics) collects the timings and counts of the import, and decides whether
+                             messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return results : (list) one ImportResult (original path, final path, status, error) per music file
+    """
+
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if len(unknown) > 0:
+        raise ValueError('Unknown stages: {0}. Stages must be among {1}'.format(unknown, STAGES))
+
+    metrics = get_metrics(metrics, progress)
+    root = pathlib.Path(os.path.abspath(folder))
+    if art_cache is None:
+        art_cache = AlbumArtCache()
+
+    # Clean up the folder names first, deepest folders first, so every path found
+    # afterwards is final
+    if 'folders' in stages:
+        with metrics.timer('discovery'):
+            walk = list(walk_folders_bottom_up(root, max_nesting, metrics))
+        for dirpath, subdirs in walk:
+            renames = folder_renames(dirpath, subdirs, titlecase, titlecase_list)
+            if len(renames) > 0:
+                apply_renames(plan_renames(renames), undo_path, metrics)
+
+    # A single pass over the files, picking up both the music files and the images
+    extensions = tuple(FILETYPES.keys()) + QOBUZ_IMAGE_TYPES
+    with metrics.timer('discovery'):
+        entries = list(scan_files(root, extensions, metrics))
+    mfs = sorted(pathlib.Path(entry.path) for entry in entries
+                 if os.path.splitext(entry.name)[1].lower() in FILETYPES)
+    images = [pathlib.Path(entry.path) for entry in entries
+              if os.path.splitext(entry.name)[1].lower() in QOBUZ_IMAGE_TYPES]
+
+    if 'images' in stages:
+        clean_image_files(images, metrics)
+
+    # Group the music files by album folder
+    albums = collections.defaultdict(list)
+    for mf in mfs:
+        albums[_album_folder(mf, root, album_nesting)].append(mf)
+
+    # Work out the album, year and sort album tags of each album
+    tags_by_album = {}
+    if 'discography' in stages:
+        album_folders = [album for album in albums if album is not None]
+        if years is None:
+            # Print the list of folders found (so the user can verify the script found the album folders as intended)
+            print('\nFolder:', root)
+            print('Albums found:')
+            for p in album_folders:
+                print(p.name)
+            album_years = ask_album_years(album_folders)
+        else:
+            album_years = {p: album_year(years, p) for p in album_folders}
+        for p, sortstr in album_years.items():
+            if sortstr is None:
+                metrics.event('No year given for album {0}, skipping its album tags'.format(p), level=logging.WARNING,
+                              path=p)
+            else:
+                tags_by_album[p] = album_tags(p.name, sortstr)
+
+    # Open each music file once, apply all tag changes and the album cover, and save it once
+    results = []
+    renames = []
+    for album, album_files in albums.items():
+        albumcover_path = None
+        if 'cover' in stages and album is not None:
+            albumcover_path = find_album_cover(album, image_filetypes)
+            if albumcover_path is None:
+                metrics.event('No album cover found for album {0}'.format(album.name), level=logging.WARNING,
+                              path=album, album=album.name)
+        for mf in album_files:
+            try:
+                tag_obj = AudioWrapper(mf, tagdf, metrics=metrics)
+                if 'cleanup' in stages:
+                    _clean_tags(tag_obj, mf, strip_tags, metrics)
+                if album in tags_by_album:
+                    tag_obj.set_values(tags_by_album[album])
+                if albumcover_path is not None:
+                    tag_obj.add_album_art(art_cache.get(albumcover_path, tag_obj.filetype))
+                # Work out the new filename before saving; files without a title keep their name
+                rename = None
+                if 'filenames' in stages:
+                    title = tag_obj.get_value('title')
+                    if isinstance(title, str) and title != '':
+                        rename = (mf, _title_filename(mf, title, titlecase, titlecase_list))
+                    else:
+                        metrics.event('File {0} has no title, not renaming it'.format(mf), level=logging.WARNING,
+                                      path=mf)
+                # Files where nothing actually changed are not written
+                status = 'saved' if tag_obj.save() else 'unchanged'
+                result = ImportResult(mf, mf, status, None)
+                if rename is not None:
+                    renames.append(rename)
+            except Exception as e:
+                error = '{0}: {1}'.format(type(e).__name__, e)
+                metrics.count('errors')
+                metrics.event('could not import file {0}: {1}'.format(mf, error), level=logging.WARNING,
+                              path=mf, error=error)
+                result = ImportResult(mf, mf, 'failed', error)
+            results.append(result)
+            metrics.step(len(results), len(mfs), mf)
+
+    _update_journal(index_path, [result.path for result in results if result.status == 'saved'])
+
+    # Rename the files after their titles, all files in a folder in one go
+    if len(renames) > 0:
+        new_paths = {}
+        for folder_renames in group_by_folder(renames):
+            plan = apply_renames(plan_renames(folder_renames), undo_path, metrics)
+            new_paths.update((op.src, op.dst) for op in plan if op.status == 'renamed')
+        results = [result._replace(path=new_paths.get(result.path, result.path)) for result in results]
+
+    counts = collections.Counter(result.status for result in results)
+    metrics.event('Imported {0} files: saved {1}, skipped {2} unchanged files, {3} files failed'.format(
+                  len(results), counts['saved'], counts['unchanged'], counts['failed']), **counts)
+    metrics.finish('import_download')
+
+    return results
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+
+# Phases timed by Metrics: walking the folders, opening and parsing files, reading tag values,
+# saving tags, renaming files/folders and processing the library dataframe
+PHASES = ('discovery', 'open/parse', 'tag read', 'tag write', 'rename', 'analysis')
+
+# Messages are printed by Metrics itself; the logger only has handlers if the application adds them
+logger = logging.getLogger('boogie_manager')
+logger.addHandler(logging.NullHandler())
+
+
+class Metrics:
+
+    """
+    Metrics : collects timings and counts for a batch operation, and decides how it reports what it does.
+              Per phase (see PHASES) it keeps the total time spent; counters include 'files opened',
+              'files saved', 'files renamed', 'errors', 'file bytes opened' and 'file bytes saved' (the
+              total size of the files opened and saved. These are not the bytes actually read or written:
+              quick reads only read the tags, and saving into padding only rewrites the tags).
+              Every message (e.g. 'renamed file X to Y') is printed (unless in quiet mode) and logged to the
+              'boogie_manager' logger, with its details as a dictionary in the 'event' attribute of the
+              log record. Pass the same Metrics object to several operations to add up their numbers
+    """
+
+    def __init__(self, quiet=False, progress=None, profile=False, n_slowest=20):
+
+        """
+        :param quiet     : (bool) if True, messages are only logged, not printed
+        :param progress  : (function) function called after each file is processed, with the number of
+                           files done, the total number of files (None if not known up front) and the
+                           path of the file just processed
+        :param profile   : (bool) if True, the time spent on each file is recorded as well, and the slowest
+                           files are reported at the end of each operation
+        :param n_slowest : (int) number of slowest files to report in profiling mode
+        """
+
+        self.quiet = quiet
+        self.progress = progress
+        self.profile = profile
+        self.n_slowest = n_slowest
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.file_times = collections.defaultdict(float)
+        # Files may be processed by several threads at once (e.g. in 'batch_add_album_art')
+        self._lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def timer(self, phase, path=None):
+
+        """
+        timer : context manager adding the time spent inside it to a phase (and, in profiling mode, to a file)
+
+        :param phase : (str) name of the phase, e.g. 'tag write'
+        :param path  : (Path) file being processed, if any
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timers[phase] += elapsed
+                if self.profile and path is not None:
+                    self.file_times[str(path)] += elapsed
+
+
+    def count(self, name, n=1):
+
+        """
+        count : adds to a counter
+
+        :param name : (str) name of the counter, e.g. 'files saved'
+        :param n    : (int) amount to add
+        """
+
+        with self._lock:
+            self.counters[name] += n
+
+
+    def event(self, message, level=logging.INFO, **details):
+
+        """
+        event : reports something that happened, e.g. a file being renamed
+
+        :param message : (str) human-readable message
+        :param level   : (int) logging level
+        :param details : details of the event (e.g. path=..., new_path=...), attached to the log record
+        """
+
+        if not self.quiet:
+            print(message)
+        logger.log(level, message, extra={'event': details})
+
+
+    def step(self, done, total, path=None):
+
+        """
+        step : reports progress to the progress callback (if any)
+
+        :param done  : (int) number of files processed so far
+        :param total : (int) total number of files to process, or None if not known up front
+        :param path  : (Path) file just processed
+        """
+
+        if self.progress is not None:
+            self.progress(done, total, path)
+
+
+    def slowest_files(self, n=None):
+
+        """
+        slowest_files : gets the files that took the most time (only recorded in profiling mode)
+
+        :param n : (int) number of files. If None, 'n_slowest' is used
+
+        :return slowest : (list) list of (path, seconds) tuples, slowest first
+        """
+
+        return sorted(self.file_times.items(), key=lambda item: item[1], reverse=True)[:n or self.n_slowest]
+
+
+    def summary(self):
+
+        """
+        summary : gets all timings and counts collected so far
+
+        :return summary : (dict) dictionary with 'timers' (seconds per phase), 'counters' and (in profiling
+                          mode) 'slowest' (see 'slowest_files')
+        """
+
+        summary = {'timers': dict(self.timers), 'counters': dict(self.counters)}
+        if self.profile:
+            summary['slowest'] = self.slowest_files()
+
+        return summary
+
+
+    def finish(self, operation):
+
+        """
+        finish : called at the end of an operation: logs the summary, and in profiling mode also
+                 reports the time per phase and the slowest files
+
+        :param operation : (str) name of the operation, e.g. 'batch_cleanup'
+        """
+
+        summary = self.summary()
+        logger.info('{0} finished'.format(operation), extra={'event': summary})
+        if self.profile and not self.quiet:
+            print('Time per phase ({0}):'.format(operation))
+            for phase, seconds in summary['timers'].items():
+                print('    {0:<12} {1:8.3f} s'.format(phase, seconds))
+            print('Slowest files:')
+            for path, seconds in summary['slowest']:
+                print('    {0:8.3f} s  {1}'.format(seconds, path))
+
+
+def get_metrics(metrics=None, progress=None):
+
+    """
+    get_metrics : gets the Metrics object for an operation
+
+    :param metrics  : (Metrics) Metrics object passed in by the caller. If None, a new one is made
+    :param progress : (function) progress callback (see 'Metrics') to attach, if any
+
+    :return metrics : (Metrics) the Metrics object to use
+    """
+
+    if metrics is None:
+        metrics = Metrics(progress=progress)
+    elif progress is not None:
+        metrics.progress = progress
+
+    return metrics
+
+
+def report(metrics, message, level=logging.INFO, **details):
+
+    """
+    report : like 'Metrics.event', but prints the message if there is no Metrics object
+
+    :param metrics : (Metrics) Metrics object, or None
+    :param message : (str) human-readable message
+    :param level   : (int) logging level
+    :param details : details of the event, attached to the log record
+    """
+
+    if metrics is None:
+        print(message)
+    else:
+        metrics.event(message, level, **details)
+
+
+def timer(metrics, phase, path=None):
+
+    """
+    timer : like 'Metrics.timer', but does nothing if there is no Metrics object
+
+    :param metrics : (Metrics) Metrics object, or None
+    :param phase   : (str) name of the phase
+    :param path    : (Path) file being processed, if any
+
+    :return context : context manager timing the phase
+    """
+
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(phase, path)
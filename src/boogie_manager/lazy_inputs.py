@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import collections.abc
+import csv
+
+
+# Plain Python versions of the tables in the 'inputs' folder, which are only read from disk the first
+# time they are used. This keeps importing the package fast (no pandas, no CSV parsing at import time)
+
+
+class TagSchema(collections.abc.Mapping):
+
+    """
+    TagSchema : mapping of each supported file type (e.g. 'MP3') to a dictionary mapping human-readable tag
+                names (e.g. 'artist', 'album') to the field name used for that tag on that type of file
+                (None if the tag isn't supported for that file type). Read from a CSV file (e.g.
+                'inputs/fieldnames.csv') the first time it is used
+    """
+
+    def __init__(self, csv_path, delimiter=';'):
+
+        """
+        :param csv_path  : (Path) path of the CSV file, with the file types in the header row and one row
+                           per tag name
+        :param delimiter : (str) delimiter used in the CSV file
+        """
+
+        self.csv_path = csv_path
+        self.delimiter = delimiter
+        self._fieldmaps = None
+        self._tagnames = None
+
+
+    def _load(self):
+
+        # Read the CSV file (once)
+        if self._fieldmaps is None:
+            with open(self.csv_path, encoding='utf-8-sig', newline='') as f:
+                rows = [row for row in csv.reader(f, delimiter=self.delimiter) if row]
+            filetypes = rows[0][1:]
+            self._tagnames = [row[0] for row in rows[1:]]
+            self._fieldmaps = {filetype: {row[0]: (row[i + 1] if len(row) > i + 1 and row[i + 1] else None)
+                                          for row in rows[1:]}
+                               for i, filetype in enumerate(filetypes)}
+
+        return self._fieldmaps
+
+
+    @property
+    def tagnames(self):
+
+        """
+        tagnames : (list) all tag names, in the order they appear in the CSV file
+        """
+
+        self._load()
+        return self._tagnames
+
+
+    def __getitem__(self, filetype):
+        return self._load()[filetype]
+
+
+    def __iter__(self):
+        return iter(self._load())
+
+
+    def __len__(self):
+        return len(self._load())
+
+
+class WordList(collections.abc.Sequence):
+
+    """
+    WordList : sequence of words read from one column of a CSV file (e.g. 'inputs/titlecase_words.csv')
+               the first time it is used
+    """
+
+    def __init__(self, csv_path, column='word'):
+
+        """
+        :param csv_path : (Path) path of the CSV file, with a header row
+        :param column   : (str) name of the column to read the words from
+        """
+
+        self.csv_path = csv_path
+        self.column = column
+        self._words = None
+
+
+    def _load(self):
+
+        # Read the CSV file (once)
+        if self._words is None:
+            with open(self.csv_path, encoding='utf-8-sig', newline='') as f:
+                self._words = tuple(row[self.column] for row in csv.DictReader(f))
+
+        return self._words
+
+
+    def __getitem__(self, i):
+        return self._load()[i]
+
+
+    def __len__(self):
+        return len(self._load())
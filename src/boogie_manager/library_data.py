@@ -1,14 +1,119 @@
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
+import itertools
+import json
+import logging
 import numpy as np
+import os
 import pandas as pd
 import pathlib
 
-from .base import AudioWrapper
+from .base import AudioWrapper, tag_names
+from .discovery import scan_changed_files, scan_files
+from .instrumentation import get_metrics, report, timer
+from .library_index import LibraryIndex
+from .quick_read import read_padding
 from .set_defaults import *
 
 
-def grab_all_music_files(basepath=ROOTFOLDER, require_numeric=True, tagdf=FIELDNAMES):
+def read_file_record(mf, alltags, tagdf=FIELDNAMES, metrics=None):
+
+    """
+    read_file_record : reads the metadata and length of a single music file
+
+    :param mf      : (Path) path of the music file
+    :param alltags : (list) names of the tags to read (as they appear in the index of 'tagdf')
+    :param tagdf   : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                     and human-readable tag names (e.g. 'artist', 'album') as rows.
+                     Each element is the field name to be used for that tag on that
+                     type of file
+    :param metrics : (Metrics) Metrics object to record the time spent reading the file in (see
+                     'instrumentation'). If None, nothing is recorded
+
+    :return record : (list) the value of each tag in 'alltags', followed by the length of the file.
+                     Tag values are plain Python values (see '_plain_value')
+    """
+
+    tag_obj = AudioWrapper(mf, tagdf, read_only=True, metrics=metrics)
+    record = [_plain_value(val) for val in tag_obj.get_values(alltags).values()]
+    record.append(tag_obj.get_length())
+
+    return record
+
+
+def _plain_value(val):
+
+    # Mutagen returns some values as its own types (e.g. ID3 timestamps, or MP4 freeform tags,
+    # which are bytes) and MP4 flags as booleans; turn these into strings, so every tag column
+    # only holds strings, numbers and NaN
+    if isinstance(val, bool):
+        return '1' if val else '0'
+    elif isinstance(val, (str, int, float)):
+        return val
+    elif isinstance(val, bytes):
+        return val.decode('utf-8', 'replace')
+    else:
+        return str(val)
+
+
+def _read_file_chunk(mfs, alltags, tagdf):
+
+    # Worker function for 'read_file_records': reads a chunk of files in one go,
+    # so only one task per chunk has to be sent to (and returned from) the worker process
+    return [read_file_record(mf, alltags, tagdf) for mf in mfs]
+
+
+def read_file_records(mfs, alltags, tagdf=FIELDNAMES, workers=None, chunksize=64, metrics=None):
+
+    """
+    read_file_records : reads the metadata and length of a list of music files, either
+                        serially or spread across a pool of worker processes
+
+    :param mfs       : (list) paths of the music files
+    :param alltags   : (list) names of the tags to read (as they appear in the index of 'tagdf')
+    :param tagdf     : (TagSchema or DataFrame) tag schema with the supported file types as columns
+                       and human-readable tag names (e.g. 'artist', 'album') as rows.
+                       Each element is the field name to be used for that tag on that
+                       type of file
+    :param workers   : (int) number of worker processes. If None or 1, the files are read
+                       in the current process. N.B.: on Windows, scripts using worker processes
+                       must call this from within an 'if __name__ == '__main__':' block
+    :param chunksize : (int) number of files handed to a worker process at a time
+    :param metrics   : (Metrics) Metrics object to record the time spent reading the files in, and to report
+                       progress to (see 'instrumentation'). With worker processes, only the total time
+                       per chunk is recorded, and progress is reported per chunk. If None, nothing is recorded
+
+    :return records : (list) one record per file (see 'read_file_record'), in the same order as 'mfs'
+    """
+
+    if workers is None or workers <= 1 or len(mfs) <= chunksize:
+        records = []
+        for mf in mfs:
+            records.append(read_file_record(mf, alltags, tagdf, metrics))
+            if metrics is not None:
+                metrics.step(len(records), len(mfs), mf)
+        return records
+
+    # Parsing the tags is CPU-bound (in mutagen), so use processes rather than threads.
+    # 'map' returns the chunks in order, so the output is identical to the serial path
+    chunks = [mfs[i:i + chunksize] for i in range(0, len(mfs), chunksize)]
+    records = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        chunk_records = executor.map(_read_file_chunk, chunks, itertools.repeat(alltags), itertools.repeat(tagdf))
+        # The Metrics object can't be shared with the worker processes, so time the chunks as they come in
+        for chunk in chunks:
+            with timer(metrics, 'open/parse'):
+                records.extend(next(chunk_records))
+            if metrics is not None:
+                metrics.count('files opened', len(chunk))
+                metrics.step(len(records), len(mfs), chunk[-1])
+
+    return records
+
+
+def grab_all_music_files(basepath=ROOTFOLDER, require_numeric=True, tagdf=FIELDNAMES, index_path=None,
+                         workers=None, compact=False, use_journal=False, progress=None, metrics=None):
     
     """
     grab_all_music_files : creates a dataframe of all music files in the library with their metadata
@@ -19,50 +124,347 @@ def grab_all_music_files(basepath=ROOTFOLDER, require_numeric=True, tagdf=FIELDN
                              E.g. a folder '01 metal' or '05 jazz' will be included but 'new downloads'
                              or 'to be added' will not.
                              If False, all contents of 'basepath' will be included 
-    :param tagdf           : (DataFrame) dataframe with the supported file types as columns
+    :param tagdf           : (TagSchema or DataFrame) tag schema with the supported file types as columns
                              and human-readable tag names (e.g. 'artist', 'album') as rows.
                              Each element is the field name to be used for that tag on that
                              type of file
+    :param index_path      : (str) path of a persistent index file (see 'LibraryIndex'). If given, files
+                             whose size and modification time haven't changed since the last scan are
+                             served from the index instead of being re-read; new and modified files are
+                             read and added to the index, and deleted files are removed from it.
+                             If None, every file is read
+    :param workers         : (int) number of worker processes to read the files with (see
+                             'read_file_records'). If None, all files are read in the current process
+    :param compact         : (bool) if True, the dataframe is returned in the compact layout (see
+                             'compact_library_frame'), which takes a lot less memory
+    :param use_journal     : (bool) if True (and 'index_path' is given), only the folders whose modification
+                             time changed since the last scan are listed, and only the files in those folders
+                             are checked; files in unchanged folders are served from the index without even
+                             looking at them (see 'scan_changed_files'). N.B.: files edited in place by other
+                             programs are only picked up if their folder is removed from the journal
+                             (the batch operations in 'batch_ops' do this when given the index path)
+    :param progress        : (function) called after each file read with the number of files read, the total
+                             number of files to read and the path of the file, e.g. to update a progress bar
+    :param metrics         : (Metrics) collects the timings and counts of the scan, and decides whether
+                             messages are printed (see 'instrumentation'). If None, a new one is used
                       
     return df : (DataFrame) dataframe with the file paths as rows and the tags (as 
                 they appear in the index of 'tagdf') as columns. Each element is the
-                value of that tag for that file
-    """
-
-    # Grab all the music files (MP3/MP4/FLAC) in the selected folder
-    # (see note on 'require_numeric' in docstring)
-    masterlist = []
-    p = pathlib.Path(basepath)
-    toplevel_dirs = list(p.glob('*'))
-    for dn in toplevel_dirs:
-        if dn.is_dir() and (dn.stem[:2].isnumeric() or require_numeric == False):
-            masterlist.extend(list(dn.rglob('*.m4a')))
-            masterlist.extend(list(dn.rglob('*.mp3')))
-            masterlist.extend(list(dn.rglob('*.flac')))
-
-    # Create an empty dataframe with the tags ('artist', 'album' etc.) as columns
-    # and the paths of the music files (relative to the root folder) as rows.
-    # From the list of tags, remove 'album art' (should not be written to the dataframe)
-    # and add a column for the length (not a tag but a property of the audio file itself)   
-    alltags = list(tagdf.index)
-    alltags.remove('album art')     
-    df = pd.DataFrame(columns=alltags + ['length'], index=[p.relative_to(basepath) for p in masterlist])
-
-    # Grab the metadata and length for each file, using the AudioWrapper class to
-    # read data from MP3, MP4 and FLAC files in the same way
-    for mf in masterlist:
-        tag_obj = AudioWrapper(mf)
-        # Grab the metadata for each file
-        for tag in alltags:
-            val = tag_obj.get_value(tag)
-            df.loc[mf.relative_to(basepath), tag] = val
-        # Grab the length for each file
-        df.loc[mf.relative_to(basepath), 'length'] = tag_obj.get_length()
+                value of that tag for that file. The 'length' column is a float (in seconds),
+                'track', 'disc' and 'year' are nullable integers (unless 'compact' is True)
+    """
+
+    # Get the top-level folders to include (see note on 'require_numeric' in docstring)
+    metrics = get_metrics(metrics, progress)
+    p = pathlib.Path(os.path.abspath(basepath))
+    with metrics.timer('discovery'), os.scandir(p) as it:
+        folders = [dn.path for dn in it if dn.is_dir() and (dn.name[:2].isnumeric() or require_numeric == False)]
+
+    # From the list of tags, remove 'album art' (should not be written to the dataframe);
+    # the length is added as an extra column (not a tag but a property of the audio file itself)
+    alltags = tag_names(tagdf)
+    alltags.remove('album art')
+
+    # Without an index, grab all the music files (MP3/MP4/FLAC) in a single walk over each
+    # top-level folder, and the metadata and length for each file, using the AudioWrapper
+    # class to read data from MP3, MP4 and FLAC files in the same way
+    if index_path is None:
+        with metrics.timer('discovery'):
+            masterlist = [pathlib.Path(entry.path) for folder in folders for entry in scan_files(folder, metrics=metrics)]
+        relpaths = [mf.relative_to(p) for mf in masterlist]
+        records = read_file_records(masterlist, alltags, tagdf, workers=workers, metrics=metrics)
+        df = build_library_frame(relpaths, records, alltags)
+        metrics.finish('grab_all_music_files')
+        return compact_library_frame(df) if compact else df
+
+    # With an index, only read the files that are new or whose size or modification
+    # time changed since they were indexed; serve the rest from the index.
+    # The index is wiped automatically if the list of tags has changed
+    with LibraryIndex(index_path, schema='|'.join(alltags + ['length'])) as index:
+        indexed = index.entries()
+
+        # Walk the library, keeping the directory entries so their size and modification time can be
+        # checked. With the journal, folders that haven't changed aren't listed, and the files in them
+        # are assumed to be unchanged as well
+        with metrics.timer('discovery'):
+            # (either way, the files are kept in the order they are found in, so the rows of the
+            # dataframe don't depend on which folders changed)
+            if use_journal:
+                journal = index.dirs()
+                files = []
+                visited = set()
+                for folder in folders:
+                    folder_files, updates, folder_visited = scan_changed_files(folder, journal, metrics=metrics)
+                    files.extend(folder_files)
+                    visited.update(folder_visited)
+                    index.store_dirs(updates)
+                index.remove_dirs([dirpath for dirpath in journal if dirpath not in visited])
+            else:
+                files = [(entry.path, entry) for folder in folders for entry in scan_files(folder, metrics=metrics)]
+
+        relpaths = []
+        hits = []
+        to_read = []
+        new_rows = []
+        for path, entry in files:
+            mf = pathlib.Path(path)
+            relpath = mf.relative_to(p)
+            relpaths.append(relpath)
+            key = relpath.as_posix()
+            if entry is None and key in indexed:
+                hits.append(key)
+                continue
+            st = entry.stat() if entry is not None else os.stat(path)
+            if indexed.get(key) == (st.st_size, st.st_mtime_ns):
+                hits.append(key)
+            else:
+                to_read.append(mf)
+                new_rows.append((key, st.st_size, st.st_mtime_ns))
+        records_by_path = index.get_records(hits)
+        records = read_file_records(to_read, alltags, tagdf, workers=workers, metrics=metrics)
+        new_rows = [row + (record,) for row, record in zip(new_rows, records)]
+        records_by_path.update((row[0], row[3]) for row in new_rows)
+        index.store(new_rows)
+
+        # Remove files that no longer exist from the index
+        removed = [key for key in indexed if key not in records_by_path]
+        index.remove(removed)
+
+    df = build_library_frame(relpaths, [records_by_path[relpath.as_posix()] for relpath in relpaths], alltags)
+    df.attrs['scan_stats'] = {'cache hits': len(hits), 'rescanned': len(new_rows), 'removed': len(removed)}
+    metrics.event('Library index: {0} cache hits, {1} files rescanned, {2} deleted files removed'.format(
+                  len(hits), len(new_rows), len(removed)), **df.attrs['scan_stats'])
+    metrics.finish('grab_all_music_files')
+
+    return compact_library_frame(df) if compact else df
+
+
+def build_library_frame(relpaths, records, alltags):
+
+    """
+    build_library_frame : builds the library dataframe from the records read from each file in one go,
+                          and converts the numeric columns to numeric types
+
+    :param relpaths : (list) paths of the music files, relative to the root of the library
+    :param records  : (list) one record per file (see 'read_file_record'), in the same order as 'relpaths'
+    :param alltags  : (list) names of the tags in each record (as they appear in the index of 'tagdf')
+
+    :return df : (DataFrame) dataframe with the file paths as rows and the tags as columns (see
+                 'grab_all_music_files')
+    """
+
+    df = pd.DataFrame(records, index=pd.Index(relpaths, dtype=object), columns=alltags + ['length'], dtype=object)
+
+    # The length is always a number of seconds. Track and disc numbers may be stored as 'x/y'
+    # ('track X out of Y tracks total'), and years as full dates (e.g. '1999-05-01'),
+    # so only keep the leading number
+    df['length'] = pd.to_numeric(df['length'], errors='coerce').astype(float)
+    for col, pattern in [('track', r'^\s*(\d+)'), ('disc', r'^\s*(\d+)'), ('year', r'^\s*(\d{4})')]:
+        if col in df.columns:
+            numbers = df[col].astype(str).str.extract(pattern, expand=False)
+            df[col] = pd.to_numeric(numbers, errors='coerce').astype('Int64')
 
     return df
 
 
-def add_derived_cols(df, sourcedict=SOURCEDICT, sep='.'):
+def compact_library_frame(df, categorical_cols=CATEGORICAL_COLS):
+
+    """
+    compact_library_frame : converts the library dataframe to a more compact layout: columns with few
+                            distinct values (artists, genres etc.) become categoricals, the length a 32-bit
+                            float and the track, disc and year numbers 16-bit (nullable) integers.
+                            Grouping on the categorical columns is faster as well
+
+    :param df               : (DataFrame) dataframe as returned by 'grab_all_music_files' (or 'add_derived_cols')
+    :param categorical_cols : (list) columns to convert to categoricals (columns missing from the dataframe
+                              are skipped)
+
+    :return df_compact : (DataFrame) copy of the dataframe in the compact layout
+    """
+
+    df_compact = df.copy()
+    for col in categorical_cols:
+        if col in df_compact.columns:
+            df_compact[col] = df_compact[col].astype('category')
+    if 'length' in df_compact.columns:
+        df_compact['length'] = df_compact['length'].astype('float32')
+    # Only downcast the numbers if they all fit in 16 bits
+    for col in ['track', 'disc', 'year']:
+        if col in df_compact.columns and not (df_compact[col].abs() > np.iinfo(np.int16).max).any():
+            df_compact[col] = df_compact[col].astype('Int16')
+
+    return df_compact
+
+
+def memory_report(df, categorical_cols=CATEGORICAL_COLS, progress=None, metrics=None):
+
+    """
+    memory_report : compares the memory used by each column of the library dataframe in the standard and
+                    the compact layout (see 'compact_library_frame')
+
+    :param df               : (DataFrame) dataframe in the standard layout, as returned by 'grab_all_music_files'
+    :param categorical_cols : (list) columns to convert to categoricals in the compact layout
+    :param progress         : (function) called once all rows are done, with the number of rows done, the total
+                              number of rows and None (the rows are processed in bulk, not one by one)
+    :param metrics          : (Metrics) collects the time taken, and reports the totals (see 'instrumentation').
+                              If None, a new one is used
+
+    :return df_memory : (DataFrame) dataframe with the columns (plus the index and the total) as rows, and
+                        the memory used in the 'standard' and 'compact' layouts (in bytes) as columns
+    """
+
+    metrics = get_metrics(metrics, progress)
+    with metrics.timer('analysis'):
+        df_memory = pd.DataFrame({'standard': df.memory_usage(deep=True),
+                                  'compact': compact_library_frame(df, categorical_cols).memory_usage(deep=True)})
+        df_memory.loc['total'] = df_memory.sum()
+    metrics.step(len(df), len(df))
+    metrics.event('Memory usage: {0:.1f} MB in the standard layout, {1:.1f} MB in the compact layout'.format(
+                  df_memory.loc['total', 'standard'] / 1e6, df_memory.loc['total', 'compact'] / 1e6),
+                  standard=int(df_memory.loc['total', 'standard']), compact=int(df_memory.loc['total', 'compact']))
+    metrics.finish('memory_report')
+
+    return df_memory
+
+
+# Key of the snapshot file metadata written by 'save_library'
+SNAPSHOT_METADATA_KEY = b'boogie_manager'
+
+
+def save_library(df, snapshot_path):
+
+    """
+    save_library : saves the library dataframe (e.g. as returned by 'grab_all_music_files' or
+                   'add_derived_cols') to a snapshot file in the Feather format, which keeps the dtypes
+                   of all columns and can be loaded very quickly. Requires 'pyarrow'
+
+    :param df            : (DataFrame) dataframe with information about the music library
+    :param snapshot_path : (str) path of the snapshot file
+    """
+
+    # Optional dependency, only needed for snapshots
+    import pyarrow
+    import pyarrow.feather
+
+    # Feather files can't store an index of Path objects, so store the paths as a column of strings
+    df_snapshot = df.reset_index(drop=True)
+    df_snapshot.insert(0, 'path', [str(p) for p in df.index])
+
+    # Columns that hold a mix of types (e.g. numbers and strings) can't be stored either; store those as strings
+    for col in df_snapshot.columns:
+        if df_snapshot[col].dtype == object and pd.api.types.infer_dtype(df_snapshot[col]).startswith('mixed'):
+            df_snapshot[col] = df_snapshot[col].where(df_snapshot[col].isna(), df_snapshot[col].astype(str))
+
+    # Arrow has a single string type for both object columns and pandas' dedicated string dtype,
+    # so note which columns were object columns in the file's metadata, to restore them when loading
+    table = pyarrow.Table.from_pandas(df_snapshot, preserve_index=False)
+    object_cols = [col for col in df.columns if df[col].dtype == object]
+    metadata = dict(table.schema.metadata or {})
+    metadata[SNAPSHOT_METADATA_KEY] = json.dumps({'object columns': object_cols}).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    # Write the file uncompressed, so it can be memory-mapped when loading
+    pyarrow.feather.write_feather(table, snapshot_path, compression='uncompressed')
+
+
+def load_library(snapshot_path, columns=None, as_paths=False):
+
+    """
+    load_library : loads a library snapshot saved by 'save_library', with the dtypes the columns had when
+                   saved. The file is memory-mapped, and only the selected columns are read from it.
+                   N.B.: converting to a dataframe copies the data, so memory-mapping makes loading
+                   faster, but the returned dataframe takes as much memory as it would otherwise
+
+    :param snapshot_path : (str) path of the snapshot file
+    :param columns       : (list) columns to load. If None, all columns are loaded
+    :param as_paths      : (bool) if True, the index is made up of pathlib.Path objects, like the dataframe
+                           returned by 'grab_all_music_files'. If False, the paths are kept as strings,
+                           which is a lot faster for large libraries
+
+    :return df : (DataFrame) dataframe with the file paths as rows and the selected columns
+    """
+
+    # Optional dependency, only needed for snapshots
+    import pyarrow.feather
+
+    if columns is not None:
+        columns = ['path'] + [col for col in columns if col != 'path']
+    table = pyarrow.feather.read_table(snapshot_path, columns=columns, memory_map=True)
+    df = table.to_pandas()
+    paths = df.pop('path')
+
+    # Newer versions of pandas load all text columns as a dedicated string dtype, and columns without
+    # any values as None; turn the columns that were object columns when saved back into object columns
+    # with NaN. Snapshots without this information in their metadata are treated as all object columns
+    metadata = (table.schema.metadata or {}).get(SNAPSHOT_METADATA_KEY)
+    object_cols = None if metadata is None else set(json.loads(metadata)['object columns'])
+    for field in table.schema:
+        if field.name == 'path' or (object_cols is not None and field.name not in object_cols):
+            continue
+        if str(field.type) == 'null':
+            df[field.name] = pd.Series(np.nan, index=df.index, dtype=object)
+        elif isinstance(df[field.name].dtype, pd.StringDtype):
+            df[field.name] = df[field.name].astype(object)
+    if as_paths:
+        df.index = pd.Index([pathlib.Path(p) for p in paths], dtype=object)
+    else:
+        df.index = pd.Index(paths, dtype=object)
+
+    return df
+
+
+def audit_padding(basepath=ROOTFOLDER, min_padding=PADDING_MIN, progress=None, metrics=None):
+
+    """
+    audit_padding : lists the music files in the library that don't have enough padding for a typical
+                    tag edit, i.e. files where editing the tags would rewrite the entire file. Only the
+                    tag headers are read, so this is quick even for large libraries
+
+    :param basepath    : (str) root folder of the music library
+    :param min_padding : (int) minimum amount of padding (in bytes) a file should have
+    :param progress    : (function) called after each file with the number of files done, the total
+                         number of files and the path of the file, e.g. to update a progress bar
+    :param metrics     : (Metrics) collects the timings and counts of the audit, and decides whether
+                         messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return df_padding : (DataFrame) dataframe with the paths (relative to 'basepath') of the files with
+                         less than 'min_padding' bytes of padding as rows, and columns 'padding' (in bytes)
+                         and 'size' (the size of the file, i.e. how much would be rewritten, in bytes)
+    """
+
+    metrics = get_metrics(metrics, progress)
+    with metrics.timer('discovery'):
+        entries = list(scan_files(basepath, metrics=metrics))
+
+    rows = []
+    relpaths = []
+    for i, entry in enumerate(entries):
+        mf = pathlib.Path(entry.path)
+        try:
+            with metrics.timer('open/parse', mf):
+                padding = read_padding(mf)
+        except Exception as e:
+            metrics.count('errors')
+            metrics.event('could not read padding of file {0}: {1}'.format(mf, e), level=logging.WARNING,
+                          path=mf, error=str(e))
+            continue
+        finally:
+            metrics.step(i + 1, len(entries), mf)
+        metrics.count('files opened')
+        if padding < min_padding:
+            relpaths.append(mf.relative_to(basepath))
+            rows.append((padding, entry.stat().st_size))
+
+    df_padding = pd.DataFrame(rows, index=pd.Index(relpaths, dtype=object), columns=['padding', 'size'], dtype='int64')
+    metrics.event('{0} files have less than {1} bytes of padding ({2:.1f} MB would be rewritten by a tag edit)'.format(
+                  len(df_padding), min_padding, df_padding['size'].sum() / 1e6),
+                  files=len(df_padding), bytes=int(df_padding['size'].sum()))
+    metrics.finish('audit_padding')
+
+    return df_padding
+
+
+def add_derived_cols(df, sourcedict=SOURCEDICT, sep='.', progress=None, metrics=None):
 
     """
     add_derived_cols : adds some columns to the dataframe produced by 'grab_all_music_files'
@@ -74,62 +476,131 @@ def add_derived_cols(df, sourcedict=SOURCEDICT, sep='.'):
     :param sep        : (str) separator for nesting levels used in genre tags, e.g. '.', '-' or '|'.
                         If None, genre tags are assumed not to use nesting and the interpretation of
                         nesting levels is skipped. See longer comment below
+    :param progress   : (function) called once all rows are done, with the number of rows done, the total
+                        number of rows and None (the rows are processed in bulk, not one by one)
+    :param metrics    : (Metrics) collects the time taken (see 'instrumentation'). If None, a new one is used
 
     :return df_extended : (DataFrame) the original dataframe with some columns added, which
                           are derived from the information in the original columns
     """
 
-    # Make a copy so the function doesn't modify its own input
-    df_extended = df.copy()
-
-    # Add a column for the file type (the row labels are file paths)
-    df_extended['File type'] = [idx.suffix for idx in df_extended.index]
-
-    # Quirk of my library: genres are tagged with a sort of nested Dewey Decimal System
-    # e.g. '03.01.04 Philadelphia soul' (a part of '03.01 soul' which is a part of '03 soul/funk/disco').
-    # These added columns split out the genre tag to its different nesting levels,
-    # e.g. for '03.01.04 Philadelphia soul' you would end up with
-    # 'genre level 1' = '03'
-    # 'genre level 2' = '01'
-    # 'genre level 3' = '04'
-    # This for easier processing and filtering later on
-    if sep is not None:
-        max_genre_nesting = max([len(genrestring.split(sep)) for genrestring in df_extended['genre']])
-        for nest_lvl in range(max_genre_nesting):
-            df_extended['genre level {0}'.format(nest_lvl + 1)] = [np.nan for i in range(len(df_extended))]
-        for i in range(len(df_extended)):
-            genre = df_extended['genre'].iloc[i]
-            genre_levels = genre.split(sep)
+    metrics = get_metrics(metrics, progress)
+    with metrics.timer('analysis'):
+        # Make a copy so the function doesn't modify its own input
+        df_extended = df.copy()
+
+        # The row labels are file paths; split them into folder and file name as strings,
+        # so they can be processed in bulk
+        paths = pd.Series(df_extended.index.map(str), index=df_extended.index, dtype=object)
+        path_parts = paths.str.rpartition(os.sep)
+        folders, filenames = path_parts[0], path_parts[2]
+
+        # Add a column for the file type
+        df_extended['File type'] = filenames.str.extract(r'(\.[^.]+)$', expand=False).fillna('')
+
+        # Quirk of my library: genres are tagged with a sort of nested Dewey Decimal System
+        # e.g. '03.01.04 Philadelphia soul' (a part of '03.01 soul' which is a part of '03 soul/funk/disco').
+        # These added columns split out the genre tag to its different nesting levels,
+        # e.g. for '03.01.04 Philadelphia soul' you would end up with
+        # 'genre level 1' = '03'
+        # 'genre level 2' = '01'
+        # 'genre level 3' = '04'
+        # This for easier processing and filtering later on
+        if sep is not None:
             # Strip out the actual NAME of the genre - we just want the numbers
-            genre_levels[-1] = genre_levels[-1].split(' ')[0]
-            for j in range(len(genre_levels)):
-                df_extended['genre level {0}'.format(j + 1)].iloc[i] = genre_levels[j]    
-
-    genrefolders = []
-    for filepath in df_extended.index:
-        lvl1parent = filepath.parent
-        if lvl1parent.stem.startswith('Disc '):
-            genrefolders.append(str(lvl1parent.parent.parent.parent))
-        else:
-            genrefolders.append(str(lvl1parent.parent.parent))
-    df_extended['genre folder'] = genrefolders
-
-    # Get the file sources (stored in the comments)
-    # and map them to shorter category names
-    # (and sometimes multiple different values to the same category)
-    sources = []
-    for filepath in df_extended.index:
-        source = df_extended.loc[filepath, 'comment']
-        if source in sourcedict.keys():
-            sources.append(sourcedict[source])
-        else:
-            sources.append('99. Other')
-    df_extended['source'] = sources    
+            # (again only once for each distinct genre)
+            genre_codes, unique_genres = pd.factorize(df_extended['genre'].astype(object))
+            genre_numbers = pd.Series(unique_genres, dtype=object).str.split(' ', n=1).str[0]
+            genre_levels = genre_numbers.str.split(sep, expand=True, regex=False)
+            genre_levels = genre_levels.astype(object).where(genre_levels.notna(), np.nan)
+            for nest_lvl in genre_levels.columns:
+                # Genre code -1 means a missing genre tag, which gets the extra NaN at the end
+                level_values = np.append(genre_levels[nest_lvl].to_numpy(), np.nan)
+                df_extended['genre level {0}'.format(nest_lvl + 1)] = level_values[genre_codes]
+
+        # The genre folder is the folder above the artist folder, i.e. the file's folder without the
+        # artist folder, album folder (and 'Disc N' folder, if any). Many files share a folder,
+        # so only work this out once for each distinct folder
+        folder_codes, unique_folders = pd.factorize(folders)
+        unique_folders = pd.Series(unique_folders, dtype=object)
+        # (first drop the 'Disc N' folder, then exactly two more folders; folders without enough levels
+        # left end up in the root folder, '.')
+        album_folders = unique_folders.str.replace(r'[\\/]Disc [^\\/]*$', '', regex=True)
+        artist_album_pattern = r'[\\/][^\\/]+[\\/][^\\/]+$'
+        genrefolders = album_folders.str.replace(artist_album_pattern, '', regex=True)
+        genrefolders = genrefolders.where(album_folders.str.contains(artist_album_pattern, regex=True), '.')
+        df_extended['genre folder'] = genrefolders.to_numpy()[folder_codes]
+
+        # Get the file sources (stored in the comments)
+        # and map them to shorter category names
+        # (and sometimes multiple different values to the same category)
+        df_extended['source'] = df_extended['comment'].astype(object).map(sourcedict).fillna('99. Other')
+    metrics.step(len(df_extended), len(df_extended))
+    metrics.finish('add_derived_cols')
 
     return df_extended
 
 
-def check_genre_placement(df_extended, rootfolder=ROOTFOLDER, splitfolder=SPLITFOLDER):
+def index_genre_folders(rootfolder=ROOTFOLDER, depth=3, metrics=None):
+
+    """
+    index_genre_folders : lists the genre directory tree (the folders at the top 'depth' levels below the
+                          root folder) in a single walk, so genre folders can be looked up without touching
+                          the disk again
+
+    :param rootfolder : (str) root folder where the entire music library is stored
+    :param depth      : (int) number of folder levels to list
+    :param metrics    : (Metrics) Metrics object to report unreadable folders through (see 'instrumentation').
+                        If None, they are printed
+
+    :return tree : (dict) nested dictionary mapping each folder name to a dictionary of its subfolders
+                   (sorted by name)
+    """
+
+    def list_folders(folder, levels_left):
+        try:
+            with os.scandir(folder) as it:
+                names = sorted(entry.name for entry in it if entry.is_dir())
+        except (PermissionError, FileNotFoundError):
+            report(metrics, 'could not read folder {0}'.format(folder), logging.WARNING, path=folder)
+            return {}
+        if levels_left == 1:
+            return {name: {} for name in names}
+        return {name: list_folders(os.path.join(folder, name), levels_left - 1) for name in names}
+
+    return list_folders(os.fspath(rootfolder), depth)
+
+
+def find_genre_folder(tree, genre_tags):
+
+    """
+    find_genre_folder : looks up the folder where a (partial) genre tag is supposed to be stored, i.e. the
+                        first folder starting with the level 1 tag, then the first subfolder of that
+                        starting with the level 2 tag etc. If there's no subfolder for a level, music
+                        with that genre tag is supposed to be stored in the folder for the level above
+
+    :param tree       : (dict) genre directory tree, as returned by 'index_genre_folders'
+    :param genre_tags : (tuple) genre tag per nesting level, e.g. ('03', '01', '04')
+
+    :return folder : (str) path of the folder, relative to the root folder
+                     (None if there's no folder for the level 1 tag at all)
+    """
+
+    parts = []
+    for tag in genre_tags:
+        if not isinstance(tag, str):
+            # Genre tag doesn't go down to this level
+            break
+        matches = [name for name in tree if name.startswith(tag)]
+        if not matches:
+            break
+        parts.append(matches[0])
+        tree = tree[matches[0]]
+
+    return os.path.join(*parts) if parts else None
+
+
+def check_genre_placement(df_extended, rootfolder=ROOTFOLDER, splitfolder=SPLITFOLDER, progress=None, metrics=None):
 
     """
     check_genre_placement : check if each file's placement in the directory structure matches its genre tag
@@ -140,71 +611,150 @@ def check_genre_placement(df_extended, rootfolder=ROOTFOLDER, splitfolder=SPLITF
     :param rootfolder  : (str) root folder where the entire music library is stored
     :param splitfolder : (str) folder where the music of 'split' artists is stored (i.e. artists whose music
                          is split across multiple genres at the highest nesting level)
-    :param folder_df   : (DataFrame) dataframe with all the different genre tags in the library as index,
-                         and a single column which stores the (absolute) path of the folder where that genre
-                         should be stored
+    :param progress    : (function) called once all tracks are done, with the number of tracks done, the total
+                         number of tracks and None (the tracks are processed in bulk, not one by one)
+    :param metrics     : (Metrics) collects the time taken, and reports unreadable folders (see 'instrumentation').
+                         If None, a new one is used
+
+    :return df_misplaced : (DataFrame) dataframe with a row for each artist that is stored in the wrong place,
+                           with columns 'problem' (either 'misplaced' or 'split over multiple genre folders'),
+                           'supposed folder' and 'actual folders' (tuple of the artist's genre folders)
+    """
+
+    metrics = get_metrics(metrics, progress)
+    level_cols = ['genre level 1', 'genre level 2', 'genre level 3']
+
+    with metrics.timer('analysis'):
+        # Get the unique combinations of artist + genre tag + genre folder
+        # (excluding all compilation tracks)
+        df_artists_genres = df_extended.loc[df_extended['compilation'].isna()].reindex(
+                            columns=['artist'] + level_cols + ['genre folder']).drop_duplicates(
+                            ).reset_index(drop=True)
+        gb_artists_genres = df_artists_genres.groupby('artist', observed=True)
+
+        # Count the different genre tags and genre folders of each artist in one go
+        counts = gb_artists_genres.nunique(dropna=False)
+        lvl3_missing = df_artists_genres['genre level 3'].isna().groupby(df_artists_genres['artist'],
+                                                                         observed=True).any()
+        firsts = df_artists_genres.drop_duplicates('artist').set_index('artist').loc[counts.index]
+        folders = gb_artists_genres['genre folder'].unique()
+
+        # Work out how deep the artist's supposed folder is, based on their genre tag(s):
+        # 0 = split folder, 1 = level 1 folder (multiple level 2 tags), 2 = level 2 folder (multiple or missing
+        # level 3 tags), 3 = level 3 folder
+        split = counts['genre level 1'] > 1
+        in_lvl1 = ~split & (counts['genre level 2'] > 1)
+        in_lvl2 = ~split & ~in_lvl1 & ((counts['genre level 3'] > 1) | lvl3_missing)
+        depths = np.select([split, in_lvl1, in_lvl2], [0, 1, 2], default=3)
+
+    # Get the folder where each genre is SUPPOSED to be stored, from a single walk over the genre folders
+    with metrics.timer('discovery'):
+        tree = index_genre_folders(rootfolder, depth=3, metrics=metrics)
+    with metrics.timer('analysis'):
+        genre_tags = [tuple(tags[:depth]) for tags, depth in zip(firsts[level_cols].itertuples(index=False), depths)]
+        supposed_folders = {tags: find_genre_folder(tree, tags) for tags in set(genre_tags) if tags}
+        supposed = pd.Series([supposed_folders[tags] if tags else splitfolder for tags in genre_tags],
+                             index=counts.index, dtype=object)
+
+        # Compare the supposed against the actual folder
+        # If an artist's non-compilation tracks are split across multiple genre folders, something is wrong as well
+        misplaced = firsts['genre folder'] != supposed
+        split_folders = ~misplaced & (counts['genre folder'] > 1)
+        df_misplaced = pd.DataFrame({'problem': np.where(misplaced, 'misplaced', 'split over multiple genre folders'),
+                                     'supposed folder': supposed,
+                                     'actual folders': folders.map(tuple)}, index=counts.index)
+    metrics.step(len(df_extended), len(df_extended))
+    metrics.finish('check_genre_placement')
+
+    return df_misplaced.loc[misplaced | split_folders]
+
+
+def _length_cube(df_extended, dims):
+
+    # Sums up the length and number of tracks for each combination of values of 'dims'
+    df4cube = df_extended[dims + ['length']].assign(length=df_extended['length'].astype(float), tracks=1)
+    return df4cube.groupby(dims, dropna=False, observed=True)[['length', 'tracks']].sum().reset_index()
+
+
+def build_length_cube(df_extended, dims=LENGTH_CUBE_DIMS, progress=None, metrics=None):
 
     """
+    build_length_cube : sums up the playing time of the library over a set of dimensions (e.g. year, genre,
+                        source), so graphs and reports can be made without going over all tracks again.
+                        The cube has the same column names as the track-level dataframe, so it can be
+                        passed to the functions in 'graphs' instead of that dataframe
 
-    rp = pathlib.Path(rootfolder)
+    :param df_extended : (DataFrame) dataframe with information about the music library, as returned by
+                         'add_derived_cols'
+    :param dims        : (list) columns to aggregate over (columns missing from the dataframe are skipped)
+    :param progress    : (function) called once all tracks are done, with the number of tracks done, the total
+                         number of tracks and None (the tracks are processed in bulk, not one by one)
+    :param metrics     : (Metrics) collects the time taken (see 'instrumentation'). If None, a new one is used
+
+    :return cube : (DataFrame) dataframe with one row for each combination of values of 'dims' that occurs
+                   in the library (including missing values), and columns 'length' (total length in
+                   seconds) and 'tracks' (number of tracks)
+    """
 
-    # Get the unique combinations of artist + genre tag + genre folder
-    # (excluding all compilation tracks)
+    metrics = get_metrics(metrics, progress)
+    with metrics.timer('analysis'):
+        cube = _length_cube(df_extended, [dim for dim in dims if dim in df_extended.columns])
+    metrics.step(len(df_extended), len(df_extended))
+    metrics.finish('build_length_cube')
 
-    df_artists_genres = df_extended[df_extended['compilation'].isna()][[
-                        'artist', 'genre level 1', 'genre level 2', 
-                        'genre level 3', 'genre folder']].drop_duplicates(
-                        ).reset_index(drop=True)
-    gb_artists_genres = df_artists_genres.groupby('artist')
-    artists = list(gb_artists_genres.groups.keys())
+    return cube
 
-    # Get the folder where each genre is SUPPOSED to be stored
 
-    lvl1folders = {lvl1tag: str(list(rp.glob(lvl1tag + '*'))[0].relative_to(rp)) for lvl1tag in df_extended['genre level 1'].unique()}
-    lvl2folders = {}
-    for lvl2tag in df_extended.groupby(['genre level 1', 'genre level 2']).groups.keys():
-        lvl1folder = list(rp.glob(lvl2tag[0] + '*'))[0]
-        try:
-            lvl2folders[lvl2tag] = str(list(lvl1folder.glob(lvl2tag[1] + '*'))[0].relative_to(rp))
-        except IndexError:
-            lvl2folders[lvl2tag] = str(lvl1folder.relative_to(rp))
-    lvl3folders = {}
-    for lvl3tag in df_extended[~df_extended['genre level 3'].isna()].groupby(['genre level 1', 'genre level 2', 'genre level 3']).groups.keys():
-        lvl1folder = list(rp.glob(lvl3tag[0] + '*'))[0]
-        try:
-            lvl2folder = list(lvl1folder.glob(lvl3tag[1] + '*'))[0]
-        except IndexError:
-            lvl3folders[lvl3tag] = str(lvl1folder.relative_to(rp))
-            continue
-        try:
-            lvl3folders[lvl3tag] = str(list(lvl2folder.glob(lvl3tag[2] + '*'))[0].relative_to(rp))
-        except IndexError:
-            lvl3folders[lvl3tag] = str(lvl2folder.relative_to(rp))
-
-    # Get the artist's supposed folder based on their genre tag(s)
-
-    for artist in artists:
-        subdf_artist = gb_artists_genres.get_group(artist)
-        if len(subdf_artist['genre level 1'].unique()) > 1:
-            supposed_folder = splitfolder
-        elif len(subdf_artist['genre level 1'].unique()) == 1 and len(subdf_artist['genre level 2'].unique()) > 1:
-            supposed_folder = lvl1folders[subdf_artist['genre level 1'].iloc[0]]
-        elif len(subdf_artist['genre level 1'].unique()) == 1 and len(subdf_artist['genre level 2'].unique()) == 1 and \
-            (len(subdf_artist['genre level 3'].unique()) > 1 or any(subdf_artist['genre level 3'].isna())):
-            artist_genre_tag = (subdf_artist['genre level 1'].iloc[0], subdf_artist['genre level 2'].iloc[0])
-            supposed_folder = lvl2folders[artist_genre_tag]
-        else:
-            artist_genre_tag = (subdf_artist['genre level 1'].iloc[0], subdf_artist['genre level 2'].iloc[0], subdf_artist['genre level 3'].iloc[0])
-            supposed_folder = lvl3folders[artist_genre_tag]
-        genre_folder = subdf_artist['genre folder'].iloc[0]
+def update_length_cube(cube, df_old, df_new, progress=None, metrics=None):
 
-        # Compare the supposed against the actual folder
-        if genre_folder != supposed_folder:
-            print('Artist misplaced:', artist)
-            print('Supposed location:', supposed_folder)
-            print('Actual location:', genre_folder)
-        # If an artist's non-compilation tracks are split across multiple genre folders, something is wrong as well
-        elif len(subdf_artist['genre folder'].unique()) > 1:
-            print('Artist split over multiple genre folders:', artist)
-            print(subdf_artist['genre folder'].unique())
+    """
+    update_length_cube : updates a cube made by 'build_length_cube' after the track-level dataframe has
+                         changed. Only the tracks that were added, removed or changed are aggregated
+
+    :param cube     : (DataFrame) the cube made from 'df_old'
+    :param df_old   : (DataFrame) the track-level dataframe the cube was made from
+    :param df_new   : (DataFrame) the new track-level dataframe
+    :param progress : (function) called once all tracks are done, with the number of tracks done, the total
+                      number of tracks and None (the tracks are processed in bulk, not one by one)
+    :param metrics  : (Metrics) collects the time taken (see 'instrumentation'). If None, a new one is used
+
+    :return cube : (DataFrame) the cube for 'df_new'
+    """
 
+    metrics = get_metrics(metrics, progress)
+    with metrics.timer('analysis'):
+        cube = _update_length_cube(cube, df_old, df_new)
+    metrics.step(len(df_new), len(df_new))
+    metrics.finish('update_length_cube')
+
+    return cube
+
+
+def _update_length_cube(cube, df_old, df_new):
+
+    # See 'update_length_cube'
+    dims = [col for col in cube.columns if col not in ('length', 'tracks')]
+    cols = dims + ['length']
+    old_rows = df_old[cols]
+    new_rows = df_new[cols]
+
+    # Find the tracks that changed in any of the cube's columns
+    common = old_rows.index.intersection(new_rows.index)
+    old_common = old_rows.loc[common].astype(object)
+    new_common = new_rows.loc[common].astype(object)
+    same = ((old_common == new_common) | (old_common.isna() & new_common.isna())).all(axis=1)
+    changed = common[~same.to_numpy()]
+
+    # Take the old versions of removed and changed tracks out of the cube, and add the new versions
+    removed = old_rows.loc[old_rows.index.difference(new_rows.index).union(changed)]
+    added = new_rows.loc[new_rows.index.difference(old_rows.index).union(changed)]
+    if len(removed) == 0 and len(added) == 0:
+        return cube
+    removed_cube = _length_cube(removed, dims)
+    removed_cube[['length', 'tracks']] = -removed_cube[['length', 'tracks']]
+    parts = [part for part in (cube, removed_cube, _length_cube(added, dims)) if len(part) > 0]
+    cube = pd.concat(parts, ignore_index=True).groupby(dims, dropna=False, observed=True)[
+        ['length', 'tracks']].sum().reset_index()
+
+    # Drop the combinations that no longer have any tracks
+    return cube.loc[cube['tracks'] > 0].reset_index(drop=True)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import pathlib
+import pickle
+import sqlite3
+
+
+class LibraryIndex:
+
+    """
+    LibraryIndex : persistent on-disk index (SQLite) of the metadata of all music files in the library.
+                   Entries are keyed by the path of each file relative to the library root, and are only
+                   considered valid as long as the size and modification time of the file haven't changed.
+                   The index also holds a journal of the folders in the library (see 'scan_changed_files'),
+                   so folders that haven't changed don't have to be listed again
+    """
+
+    def __init__(self, index_path, schema):
+
+        """
+        :param index_path : (Path) path of the SQLite file to store the index in. Created if it doesn't exist yet
+        :param schema     : (str) string describing the layout of the stored records (e.g. the tag names, in
+                            order). If it doesn't match the schema the index was created with, the index is
+                            wiped, so records with a different layout are never served. If None, the schema
+                            isn't checked (e.g. when only the folder journal is used)
+        """
+
+        self.index_path = pathlib.Path(index_path)
+        self.conn = sqlite3.connect(str(self.index_path))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (relpath TEXT PRIMARY KEY, size INTEGER, '
+                          'mtime INTEGER, record BLOB)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER, '
+                          'entries INTEGER, contents BLOB)')
+
+        # Wipe the index if it was made for a different set of tags
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+        if schema is not None and (row is None or row[0] != schema):
+            self.conn.execute('DELETE FROM files')
+            self.conn.execute('DELETE FROM dirs')
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)", (schema,))
+        self.conn.commit()
+
+
+    def entries(self):
+
+        """
+        entries : reads the (size, modification time) signature of every file in the index
+
+        :return entries : (dict) dictionary mapping relative paths (as POSIX strings) to (size, mtime) tuples
+        """
+
+        return {relpath: (size, mtime) for relpath, size, mtime in
+                self.conn.execute('SELECT relpath, size, mtime FROM files')}
+
+
+    def get_records(self, relpaths):
+
+        """
+        get_records : reads the stored records of the given files
+
+        :param relpaths : (list) relative paths (as POSIX strings) of the files
+
+        :return records : (dict) dictionary mapping relative paths to the stored records
+        """
+
+        records = {}
+        cursor = self.conn.cursor()
+        # SQLite limits the number of parameters per query, so look up the paths in chunks
+        relpaths = list(relpaths)
+        for i in range(0, len(relpaths), 500):
+            chunk = relpaths[i:i + 500]
+            query = 'SELECT relpath, record FROM files WHERE relpath IN ({0})'.format(','.join('?' * len(chunk)))
+            for relpath, record in cursor.execute(query, chunk):
+                records[relpath] = pickle.loads(record)
+
+        return records
+
+
+    def store(self, rows):
+
+        """
+        store : adds or replaces records in the index
+
+        :param rows : (list) list of (relpath, size, mtime, record) tuples
+        """
+
+        self.conn.executemany('INSERT OR REPLACE INTO files (relpath, size, mtime, record) VALUES (?, ?, ?, ?)',
+                              [(relpath, size, mtime, pickle.dumps(record)) for relpath, size, mtime, record in rows])
+        self.conn.commit()
+
+
+    def remove(self, relpaths):
+
+        """
+        remove : removes files from the index (e.g. because they were deleted from the library)
+
+        :param relpaths : (list) relative paths (as POSIX strings) of the files to remove
+        """
+
+        self.conn.executemany('DELETE FROM files WHERE relpath = ?', [(relpath,) for relpath in relpaths])
+        self.conn.commit()
+
+
+    def dirs(self):
+
+        """
+        dirs : reads the folder journal
+
+        :return journal : (dict) dictionary mapping folder paths to (mtime, number of entries, subfolder names,
+                          music file names) tuples
+        """
+
+        return {path: (mtime, entries) + pickle.loads(contents) for path, mtime, entries, contents in
+                self.conn.execute('SELECT path, mtime, entries, contents FROM dirs')}
+
+
+    def store_dirs(self, journal):
+
+        """
+        store_dirs : adds or replaces folders in the folder journal
+
+        :param journal : (dict) dictionary mapping folder paths to (mtime, number of entries, subfolder names,
+                         music file names) tuples
+        """
+
+        self.conn.executemany('INSERT OR REPLACE INTO dirs (path, mtime, entries, contents) VALUES (?, ?, ?, ?)',
+                              [(path, mtime, entries, pickle.dumps((subdirs, filenames)))
+                               for path, (mtime, entries, subdirs, filenames) in journal.items()])
+        self.conn.commit()
+
+
+    def remove_dirs(self, paths):
+
+        """
+        remove_dirs : removes folders from the folder journal, so they are listed (and the files in them checked)
+                      again on the next scan. Use this for folders that no longer exist, and for folders in
+                      which files were edited in place
+
+        :param paths : (list) paths of the folders, as they are stored in the journal
+        """
+
+        self.conn.executemany('DELETE FROM dirs WHERE path = ?', [(path,) for path in paths])
+        self.conn.commit()
+
+
+    def close(self):
+
+        """
+        close : closes the connection to the index file
+        """
+
+        self.conn.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,70 +1,175 @@
 import pathlib
 
 from .set_defaults import *
+from .discovery import find_music_files, walk_folders_bottom_up
+from .instrumentation import get_metrics
+from .rename_engine import apply_renames, plan_renames, report_plan, titlecase_name
 
-def clean_album_art(folder):
+
+# Image files that come with a Qobuz download
+QOBUZ_IMAGE_TYPES = ('.png', '.jpg')
+
+
+def clean_album_art(folder, progress=None, metrics=None):
     
     """
     clean_album_art : removes Qobuz's png files and sets jpg filenames
                       to the respective album titles. Assumes there are no 2
                       jpg files directly in the same folder!
                       
-    :param folder : (str) path of the folder
+    :param folder   : (str) path of the folder
+    :param progress : (function) called after each image with the number of images done, the total
+                      number of images and the path of the image, e.g. to update a progress bar
+    :param metrics  : (Metrics) collects the timings and counts of the operation, and decides whether
+                      messages are printed (see 'instrumentation'). If None, a new one is used
     """
     
     # Get all the png files in the folder (came with Qobuz download)
-    p = pathlib.Path(folder)    
-    qobuz_pngs = list(p.rglob('*_cover.png')) + list(p.rglob('image_*.png'))
-    # Get all the jpg files (the proper high-res album art, must have been
-    # manually placed in the correct folders first)
-    jpglist = list(p.rglob('*.jpg'))
+    # and all the jpg files (the proper high-res album art, must have been
+    # manually placed in the correct folders first) in a single pass
+    metrics = get_metrics(metrics, progress)
+    p = pathlib.Path(folder)
+    with metrics.timer('discovery'):
+        images = find_music_files(p, extensions=QOBUZ_IMAGE_TYPES, metrics=metrics)
+    clean_image_files(images, metrics)
+    metrics.finish('clean_album_art')
+
+
+def clean_image_files(images, metrics):
+
+    """
+    clean_image_files : removes Qobuz's png files from a list of images, and sets jpg filenames
+                        to the respective album titles (see 'clean_album_art')
+
+    :param images  : (list) Path objects of the image files (png and jpg) found in a download
+    :param metrics : (Metrics) collects the timings and counts, and decides whether messages are
+                     printed (see 'instrumentation')
+
+    :return jpgs : (list) new Path objects of the jpg files
+    """
+
+    qobuz_pngs = [f for f in images if f.suffix.lower() == '.png' and
+                  (f.name.endswith('_cover.png') or f.name.startswith('image_'))]
+    jpglist = [f for f in images if f.suffix.lower() == '.jpg']
     
     # Delete the png files
-    for pngfile in qobuz_pngs:
+    n_images = len(qobuz_pngs) + len(jpglist)
+    for i, pngfile in enumerate(qobuz_pngs):
         pngfile.unlink()
+        metrics.count('files deleted')
+        metrics.step(i + 1, n_images, pngfile)
         
     # For all the jpgs, get the name of the folder where they reside
     # (assumed to be an album title)
     # and set the filename to this folder name
-    for jpgfile in jpglist:
+    jpgs = []
+    for i, jpgfile in enumerate(jpglist):
         albumtitle = jpgfile.parent.stem
         newfilename = albumtitle + jpgfile.suffix
         newpath = jpgfile.parent / newfilename
-        jpgfile.rename(newpath)
+        with metrics.timer('rename', jpgfile):
+            jpgfile.rename(newpath)
+        jpgs.append(newpath)
+        metrics.count('files renamed')
+        metrics.step(len(qobuz_pngs) + i + 1, n_images, jpgfile)
+
+    metrics.event('Deleted {0} Qobuz png files, renamed {1} jpg files'.format(len(qobuz_pngs), len(jpglist)),
+                  deleted=len(qobuz_pngs), renamed=len(jpglist))
+
+    return jpgs
         
     
-def clean_folders(folder, max_nesting=6, titlecase=True, titlecase_list=TITLECASE_EN):
+def normalize_folder_name(name, titlecase=True, titlecase_list=TITLECASE_EN):
+
+    """
+    normalize_folder_name : cleans up the name of a folder from a Qobuz download
+
+    :param name           : (str) folder name
+    :oaram titlecase      : (bool) whether or not to correct the folder name to "title case"
+    :param titlecase_list : (tuple) tuple of all the words to make lowercase for title case
+
+    :return name : (str) cleaned-up folder name
+    """
+
+    # Replace hyphens by spaces (by default, Qobuz downloads represent all spaces
+    # in artist/album names as hyphens in the respective folder names;
+    # this code fixes that)
+    name = name.replace('-', ' ')
+    # Replace specific words from 'titlecase_list' (e.g. 'And', 'Or')
+    # with their lower-case counterparts
+    if titlecase:
+        name = titlecase_name(name, titlecase_list)
+
+    return name
+
+
+def folder_renames(dirpath, subdirs, titlecase=True, titlecase_list=TITLECASE_EN):
+
+    """
+    folder_renames : lists the subfolders of a folder whose name changes when cleaned up (see
+                     'normalize_folder_name')
+
+    :param dirpath        : (str) path of the folder
+    :param subdirs        : (list) names of its subfolders
+    :oaram titlecase      : (bool) whether or not to correct the folder names to "title case"
+    :param titlecase_list : (tuple) tuple of all the words to make lowercase for title case
+
+    :return renames : (list) list of (old path, new path) tuples of Path objects
+    """
+
+    renames = []
+    for name in subdirs:
+        newname = normalize_folder_name(name, titlecase, titlecase_list)
+        if newname != name:
+            renames.append((pathlib.Path(dirpath, name), pathlib.Path(dirpath, newname)))
+
+    return renames
+
+
+def clean_folders(folder, max_nesting=6, titlecase=True, titlecase_list=TITLECASE_EN, dry_run=False, undo_path=None,
+                  progress=None, metrics=None):
 
     """
     clean_folders : replaces all hyphens by spaces in all folder names
-                    within the given parent folder
+                    within the given parent folder (see 'normalize_folder_name'),
+                    in a single pass over the folder tree
                       
     :param folder         : (str) path of the parent folder
     :param max_nesting    : (int) deepest nesting level to consider
     :oaram titlecase      : (bool) whether or not to correct the folder names to "title case"
     :param titlecase_list : (tuple) tuple of all the words to make lowercase for title case
+    :param dry_run        : (bool) if True, only report what would be renamed, without renaming anything
+    :param undo_path      : (str) path of an undo journal to record the renames in (see
+                            'rename_engine.undo_renames'). If None, no journal is kept
+    :param progress       : (function) called after each folder with the number of folders done, None
+                            (the total isn't known up front) and the path of the folder
+    :param metrics        : (Metrics) collects the timings and counts of the operation, and decides whether
+                            messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return results : (list) one RenameOp (old path, new path, status, error) per folder whose name
+                      changes (see 'rename_engine'). Folders that would take the name of an existing
+                      folder are reported as collisions and left as they are
     """
     
-    p = pathlib.Path(folder)
-    
-    nesting_levels = range(max_nesting, 0, -1)
-    
-    for nesting in nesting_levels:
-            # Get all the relevant folders at this nesting level    
-            globstring = '/'.join(['*' for i in range(nesting)])    
-            folders = [path for path in list(p.glob(globstring)) if path.is_dir()]
-            
-            for f in folders:
-                # Replace hyphens by spaces (by default, Qobuz downloads represent all spaces
-                # in artist/album names as hyphens in the respective folder names;
-                # this code fixes that)
-                newname = f.stem.replace('-', ' ')
-                # Replace specific words from 'titlecase_list' (e.g. 'And', 'Or')
-                # with their lower-case counterparts
-                if titlecase:
-                    for word in titlecase_list:
-                        word_padded = ' ' + word + ' '
-                        newname = newname.replace(word_padded, word_padded.lower())
-                # Generate the full new path and rename the folder
-                newpath = f.parent / newname
-                f.rename(newpath)
\ No newline at end of file
+    metrics = get_metrics(metrics, progress)
+
+    # Walk the tree once, deepest folders first, so renaming the subfolders of a folder
+    # never changes the path of a folder still to come
+    results = []
+    walk = walk_folders_bottom_up(folder, max_nesting, metrics)
+    for n_done, (dirpath, subdirs) in enumerate(walk, start=1):
+        # Only rename the subfolders whose name actually changes; all renames within
+        # a folder are planned together, so clashing names are caught
+        renames = folder_renames(dirpath, subdirs, titlecase, titlecase_list)
+        if len(renames) > 0:
+            plan = plan_renames(renames)
+            if dry_run:
+                report_plan(plan, metrics)
+                results.extend(plan)
+            else:
+                results.extend(apply_renames(plan, undo_path, metrics))
+        metrics.step(n_done, None, dirpath)
+
+    metrics.finish('clean_folders')
+
+    return results
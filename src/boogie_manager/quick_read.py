@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import struct
+import warnings
+
+import mutagen
+from mutagen.flac import FLAC, Padding, StreamInfo, VCFLACDict
+from mutagen.id3 import ID3, ParseID3v1
+from mutagen.mp3 import MP3, MPEGInfo
+from mutagen.mp4 import MP4, MP4Info, MP4Tags
+
+# The loaders below rely on some of mutagen's internals (e.g. its MP4 atom parser, and building
+# mutagen objects without calling their constructors), which may change between versions. They are
+# only used with the versions of mutagen they were tested with; with any other version (or if the
+# internals can't be found), files are always read in full by mutagen itself
+TESTED_MUTAGEN_VERSIONS = ((1, 48), (1, 48))
+
+try:
+    from mutagen.mp4._atom import Atoms
+except ImportError:
+    Atoms = None
+
+QUICK_READ_SUPPORTED = (Atoms is not None and hasattr(MP4Tags, '_can_load')
+                        and TESTED_MUTAGEN_VERSIONS[0] <= mutagen.version[:2] <= TESTED_MUTAGEN_VERSIONS[1])
+if not QUICK_READ_SUPPORTED:
+    warnings.warn('Quick read-only loading is not supported with mutagen {0}; files will be read in full'.format(
+                  mutagen.version_string))
+
+
+# Read-only loaders for MP3, MP4 and FLAC files that parse only the tag and stream info
+# regions of a file, and skip the (potentially very large) embedded pictures without
+# reading them. Each loader returns a regular mutagen object (MP3, MP4 or FLAC) whose tags
+# and info can be read as usual, but which must never be saved: the pictures are missing from
+# it, so saving would remove them from the file.
+# Files with an unusual layout (e.g. unsynchronised ID3 tags, or FLAC files with an ID3 tag in
+# front) raise FullReadRequired, in which case the caller should load the file the normal way
+
+
+class FullReadRequired(Exception):
+
+    """
+    FullReadRequired : raised when a file can't be read without its pictures, and has to be
+                       loaded in full instead
+    """
+
+
+def _syncsafe(data):
+
+    # Decodes a 4-byte ID3 'synchsafe' integer (7 bits per byte)
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _scan_id3(fileobj, skip_frames):
+
+    # Walks over the frames of the ID3v2 tag at the start of the file, seeking past the
+    # frames whose name is in 'skip_frames' (or all frames, if 'skip_frames' is None).
+    # Returns the tag header, the raw frames that weren't skipped, the offset where the
+    # tag ends and the amount of padding at the end of the tag
+    header = fileobj.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        raise FullReadRequired('no ID3v2 tag at start of file')
+    vmaj, flags = header[3], header[5]
+    # Unsynchronisation and extended headers are rare, and complicate walking
+    # over the frames, so leave those files to mutagen
+    if vmaj not in (3, 4) or flags & 0xC0:
+        raise FullReadRequired('unsupported ID3v2 layout')
+    end = 10 + _syncsafe(header[6:10])
+
+    # Walk over the frame headers
+    frames = []
+    pos = 10
+    while pos + 10 <= end:
+        frame_header = fileobj.read(10)
+        if len(frame_header) < 10:
+            raise FullReadRequired('truncated ID3 frame header')
+        name = frame_header[:4]
+        if name.strip(b'\x00') == b'':
+            # Reached the padding
+            break
+        if not name.isalnum():
+            raise FullReadRequired('invalid ID3 frame name {0}'.format(name))
+        size = struct.unpack('>L', frame_header[4:8])[0]
+        if vmaj == 4:
+            if size & 0x80808080:
+                # Some taggers (e.g. old iTunes versions) write ID3v2.4 frame sizes
+                # as plain integers; mutagen knows how to deal with this
+                raise FullReadRequired('ID3v2.4 frame size not synchsafe')
+            size = _syncsafe(frame_header[4:8])
+        if pos + 10 + size > end:
+            raise FullReadRequired('ID3 frame exceeds tag size')
+        if skip_frames is None or name in skip_frames:
+            fileobj.seek(size, 1)
+        else:
+            frames.append(frame_header + fileobj.read(size))
+        pos += 10 + size
+
+    return header, frames, end, end - pos
+
+
+def _read_id3(fileobj):
+
+    # Reads the ID3v2 tag at the start of the file, skipping the payload of APIC frames.
+    # Returns the ID3 object and the offset where the audio data starts
+    header, frames, end, _ = _scan_id3(fileobj, skip_frames=(b'APIC',))
+    flags = header[5]
+
+    # Let mutagen parse the remaining frames as if they were the whole tag
+    data = b''.join(frames)
+    size = len(data)
+    new_header = header[:5] + bytes([flags & ~0x10]) + bytes([(size >> shift) & 0x7F for shift in (21, 14, 7, 0)])
+    id3 = ID3(io.BytesIO(new_header + data), load_v1=False)
+
+    # As mutagen does, fill in any frames missing from the ID3v2 tag from an ID3v1 tag at the end
+    fileobj.seek(0, 2)
+    if fileobj.tell() >= end + 128:
+        fileobj.seek(-128, 2)
+        v1frames = ParseID3v1(fileobj.read(128), v2_version=4)
+        if v1frames:
+            for frame in v1frames.values():
+                if len(id3.getall(frame.HashKey)) == 0:
+                    id3.add(frame)
+
+    offset = end + 10 if flags & 0x10 else end
+
+    return id3, offset
+
+
+def read_mp3(p):
+
+    """
+    read_mp3 : reads the ID3 tags (without APIC payloads) and MPEG stream info of an MP3 file
+
+    :param p : (Path) pathlib.Path object of the MP3 file
+
+    :return mp3obj : (MP3) mutagen MP3 object, which must not be saved
+    """
+
+    with open(p, 'rb') as fileobj:
+        id3, offset = _read_id3(fileobj)
+        info = MPEGInfo(fileobj, offset)
+
+    mp3obj = MP3.__new__(MP3)
+    mp3obj.filename = str(p)
+    mp3obj.tags = id3
+    mp3obj.info = info
+
+    return mp3obj
+
+
+def read_mp4(p):
+
+    """
+    read_mp4 : reads the 'moov/udta/meta/ilst' tags (without 'covr' data) and stream info of an MP4 file
+
+    :param p : (Path) pathlib.Path object of the MP4 file
+
+    :return mp4obj : (MP4) mutagen MP4 object, which must not be saved
+    """
+
+    with open(p, 'rb') as fileobj:
+        # Parsing the atom tree only reads the atom headers, not their contents
+        atoms = Atoms(fileobj)
+        info = MP4Info()
+        info.load(atoms, fileobj)
+        if MP4Tags._can_load(atoms):
+            ilst = atoms.path(b'moov', b'udta', b'meta', b'ilst')[-1]
+            ilst.children = [atom for atom in ilst.children if atom.name != b'covr']
+            tags = MP4Tags(atoms, fileobj)
+        else:
+            tags = None
+
+    mp4obj = MP4.__new__(MP4)
+    mp4obj.filename = str(p)
+    mp4obj.info = info
+    mp4obj.tags = tags
+    mp4obj.chapters = None
+
+    return mp4obj
+
+
+def read_flac(p):
+
+    """
+    read_flac : reads the STREAMINFO and VORBIS_COMMENT blocks of a FLAC file, skipping all other
+                metadata blocks (PICTURE, PADDING, SEEKTABLE etc.)
+
+    :param p : (Path) pathlib.Path object of the FLAC file
+
+    :return flacobj : (FLAC) mutagen FLAC object, which must not be saved
+    """
+
+    flacobj = FLAC.__new__(FLAC)
+    flacobj.filename = str(p)
+    flacobj.metadata_blocks = []
+    flacobj.tags = None
+    flacobj.cuesheet = None
+    flacobj.seektable = None
+
+    with open(p, 'rb') as fileobj:
+        if fileobj.read(4) != b'fLaC':
+            raise FullReadRequired('no FLAC header at start of file')
+        last_block = False
+        while not last_block:
+            block_header = fileobj.read(4)
+            if len(block_header) < 4:
+                raise FullReadRequired('truncated metadata block')
+            last_block = bool(block_header[0] & 0x80)
+            code = block_header[0] & 0x7F
+            size = int.from_bytes(block_header[1:], 'big')
+            if code == StreamInfo.code:
+                block = StreamInfo(fileobj.read(size))
+            elif code == VCFLACDict.code and flacobj.tags is None:
+                block = VCFLACDict(fileobj.read(size))
+                flacobj.tags = block
+            else:
+                fileobj.seek(size, 1)
+                continue
+            block.code = code
+            flacobj.metadata_blocks.append(block)
+
+        try:
+            info = flacobj.info
+        except IndexError:
+            raise FullReadRequired('no STREAMINFO block')
+        if info.length:
+            info.bitrate = int(float(os.fstat(fileobj.fileno()).st_size - fileobj.tell()) * 8 / info.length)
+        else:
+            info.bitrate = 0
+
+    return flacobj
+
+
+def read_padding(p):
+
+    """
+    read_padding : gets the amount of padding in a file, i.e. how many bytes the tags can grow
+                   before the whole file has to be rewritten. Only the frame/block/atom headers
+                   are read, not the tags themselves
+
+    :param p : (Path) pathlib.Path object of an audio file (MP3, MP4 or FLAC)
+
+    :return padding : (int) amount of padding in bytes
+    """
+
+    if not QUICK_READ_SUPPORTED:
+        raise RuntimeError('Reading the padding is not supported with mutagen {0}'.format(mutagen.version_string))
+
+    suffix = p.suffix.lower()
+
+    with open(p, 'rb') as fileobj:
+        if suffix == '.mp3':
+            try:
+                padding = _scan_id3(fileobj, skip_frames=None)[3]
+            except FullReadRequired:
+                # Let mutagen work it out (files without an ID3v2 tag have no padding at all)
+                tags = MP3(p).tags
+                padding = 0 if tags is None else tags._padding
+        elif suffix == '.m4a':
+            # The tags can only grow into a 'free' atom directly next to the 'ilst' atom
+            padding = 0
+            atoms = Atoms(fileobj)
+            try:
+                meta, ilst = atoms.path(b'moov', b'udta', b'meta', b'ilst')[-2:]
+            except KeyError:
+                meta = None
+            if meta is not None:
+                index = meta.children.index(ilst)
+                neighbours = meta.children[max(index - 1, 0):index] + meta.children[index + 1:index + 2]
+                for atom in neighbours:
+                    if atom.name == b'free':
+                        padding = atom.datalength
+                        break
+        elif suffix == '.flac':
+            # Add up the PADDING blocks
+            padding = 0
+            if fileobj.read(4) != b'fLaC':
+                padding = sum(block.length for block in FLAC(p).metadata_blocks if block.code == Padding.code)
+            else:
+                last_block = False
+                while not last_block:
+                    block_header = fileobj.read(4)
+                    if len(block_header) < 4:
+                        break
+                    last_block = bool(block_header[0] & 0x80)
+                    size = int.from_bytes(block_header[1:], 'big')
+                    if block_header[0] & 0x7F == Padding.code:
+                        padding += size
+                    fileobj.seek(size, 1)
+        else:
+            raise ValueError('File type not supported: {0}'.format(p))
+
+    return padding
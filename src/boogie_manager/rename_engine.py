@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import functools
+import json
+import logging
+import os
+import pathlib
+import re
+import uuid
+
+from .instrumentation import get_metrics
+
+
+# Renaming all files in a folder in one go: first a plan is made of all renames (see 'plan_renames'),
+# in which renames that would overwrite another file are left out, and renames that depend on each other
+# (A -> B while B -> C, or swaps like A -> B and B -> A) are found. 'apply_renames' then carries out the
+# plan in an order that never overwrites a file, moving one file of each cycle to a temporary name first.
+# Every rename is written to an (optional) undo journal, so a batch of renames can be reverted with
+# 'undo_renames'. Operations spanning many folders plan and apply the renames of each folder on their own
+# (see 'group_by_folder'), so a rename that fails only reverts the renames in its own folder
+
+
+# Characters which are forbidden in (Windows) filenames, and what to replace them with
+FORBIDDEN_CHARS = {'?': '', '/': '-', ':': ' -', '"': '\''}
+_FORBIDDEN_PATTERN = re.compile('[' + re.escape(''.join(FORBIDDEN_CHARS)) + ']')
+
+# A single rename in a plan. 'status' is 'rename', 'cycle' (part of a cycle of renames, which goes via
+# a temporary name), 'unchanged' or 'collision' in a plan, and 'renamed' or 'failed' after applying it;
+# 'error' describes what went wrong
+RenameOp = collections.namedtuple('RenameOp', ['src', 'dst', 'status', 'error'])
+
+
+def sanitize_filename(name):
+
+    """
+    sanitize_filename : replaces the characters which are forbidden in (Windows) filenames
+                        (see FORBIDDEN_CHARS)
+
+    :param name : (str) filename (without the folder)
+
+    :return name : (str) filename without forbidden characters
+    """
+
+    return _FORBIDDEN_PATTERN.sub(lambda match: FORBIDDEN_CHARS[match.group(0)], name)
+
+
+@functools.lru_cache(maxsize=8)
+def _titlecase_pattern(words):
+
+    # One pattern matching any of the words, but only as a whole word between two spaces
+    # (so never the first or last word of a name). Longer words go first, so e.g. 'An'
+    # doesn't match the start of 'And'
+    alternatives = '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+    return re.compile('(?<= )(?:' + alternatives + ')(?= )')
+
+
+def titlecase_name(name, titlecase_list):
+
+    """
+    titlecase_name : makes specific words (e.g. 'And', 'Or') lower-case, except at the start
+                     or end of a name
+
+    :param name           : (str) name, e.g. a title or a folder name
+    :param titlecase_list : (tuple) tuple of all the words to make lowercase for title case
+
+    :return name : (str) name in title case
+    """
+
+    return _titlecase_pattern(tuple(titlecase_list)).sub(lambda match: match.group(0).lower(), name)
+
+
+def _key(path):
+
+    # Key identifying a path; on case-insensitive file systems (Windows), 'a.mp3' and 'A.mp3' are the same
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _same_file(path1, path2):
+
+    # Whether two paths point to the same file; a path that can't be checked (e.g. a file
+    # that has disappeared in the meantime) never counts as the same file
+    try:
+        return os.path.samefile(path1, path2)
+    except OSError:
+        return False
+
+
+def group_by_folder(renames):
+
+    """
+    group_by_folder : splits a batch of renames by the folder of the renamed files (or folders)
+
+    :param renames : (list) list of (old path, new path) tuples of Path objects
+
+    :return groups : (list) one list of (old path, new path) tuples per folder, in the order the folders
+                     first appear in 'renames', and with the renames in their original order
+    """
+
+    groups = collections.defaultdict(list)
+    for src, dst in renames:
+        groups[_key(src.parent)].append((src, dst))
+
+    return list(groups.values())
+
+
+def plan_renames(renames):
+
+    """
+    plan_renames : makes a plan for renaming a batch of files (or folders), without touching anything
+
+    :param renames : (list) list of (old path, new path) tuples of Path objects
+
+    :return plan : (list) one RenameOp (source, target, status, error) per rename, in the same order as
+                   'renames'. Renames whose new path equals the old one are 'unchanged'. Renames onto
+                   a file that already exists (and isn't renamed itself), or onto the same new path as
+                   another rename, are 'collision' and will not be applied. Renames that form a cycle
+                   (e.g. swapping the names of two files) are 'cycle'; all others are 'rename'
+    """
+
+    plan = {}
+    targets = collections.defaultdict(list)
+    for src, dst in renames:
+        if str(src) == str(dst):
+            plan[_key(src)] = RenameOp(src, dst, 'unchanged', None)
+        else:
+            plan[_key(src)] = RenameOp(src, dst, 'rename', None)
+            targets[_key(dst)].append(_key(src))
+
+    # Renames onto the same new path as another rename
+    for dst_key, src_keys in targets.items():
+        if len(src_keys) > 1:
+            for src_key in src_keys:
+                others = ', '.join(str(plan[other].src) for other in src_keys if other != src_key)
+                plan[src_key] = plan[src_key]._replace(status='collision', error='same new name as ' + others)
+
+    # Renames onto a file that stays where it is. Taking a rename out of the plan means its file stays
+    # where it is too, which may block another rename, so repeat until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for src_key, op in plan.items():
+            if op.status != 'rename':
+                continue
+            dst_key = _key(op.dst)
+            if dst_key in plan and dst_key != src_key:
+                blocked = plan[dst_key].status in ('unchanged', 'collision')
+            else:
+                # Renames that only change the case of the name are fine on case-insensitive file systems
+                blocked = os.path.lexists(op.dst) and not (dst_key == src_key or _same_file(op.src, op.dst))
+            if blocked:
+                plan[src_key] = op._replace(status='collision', error='{0} already exists'.format(op.dst))
+                changed = True
+
+    # Follow each chain of renames (A -> B, B -> C, ...) from its end; any renames
+    # not reached that way form cycles
+    incoming = {_key(op.dst): src_key for src_key, op in plan.items() if op.status == 'rename'}
+    reached = set()
+    for src_key, op in plan.items():
+        if op.status == 'rename' and (_key(op.dst) not in plan or _key(op.dst) == src_key):
+            while src_key is not None and src_key not in reached:
+                reached.add(src_key)
+                src_key = incoming.get(src_key)
+    for src_key, op in plan.items():
+        if op.status == 'rename' and src_key not in reached:
+            plan[src_key] = op._replace(status='cycle')
+
+    return list(plan.values())
+
+
+def _rename_steps(plan):
+
+    # Turns a plan into a list of single renames (old path, new path) that can be carried out one by one
+    # without overwriting anything: the end of each chain goes first, and one file of each cycle is moved
+    # to a temporary name first, and to its new name last
+    ops = {_key(op.src): op for op in plan if op.status in ('rename', 'cycle')}
+    incoming = {_key(op.dst): src_key for src_key, op in ops.items()}
+    steps = []
+    done = set()
+    for src_key, op in ops.items():
+        if src_key in done:
+            continue
+        if op.status == 'rename' and _key(op.dst) in ops and _key(op.dst) != src_key:
+            # Not the end of a chain; it is reached from the end of its chain
+            continue
+        first = op
+        if op.status == 'cycle':
+            tmp = op.src.with_name('.{0}.{1}.tmp'.format(op.src.name, uuid.uuid4().hex[:8]))
+            steps.append((op.src, tmp))
+        else:
+            steps.append((op.src, op.dst))
+        done.add(src_key)
+        src_key = incoming.get(src_key)
+        while src_key is not None and src_key not in done:
+            steps.append((ops[src_key].src, ops[src_key].dst))
+            done.add(src_key)
+            src_key = incoming.get(src_key)
+        if first.status == 'cycle':
+            steps.append((tmp, first.dst))
+
+    return steps
+
+
+def apply_renames(plan, undo_path=None, metrics=None):
+
+    """
+    apply_renames : carries out a rename plan (see 'plan_renames'). If a rename fails, all renames
+                    done so far are reverted, so the files are never left half-renamed. If some of
+                    them can't be reverted either, an OSError is raised, after recording everything
+                    that was reverted in the undo journal (so 'undo_renames' can finish the job)
+
+    :param plan      : (list) list of RenameOp, as returned by 'plan_renames'
+    :param undo_path : (str) path of the undo journal. Each rename is added to it as soon as it is done;
+                       pass the same path to 'undo_renames' to revert them. If None, no journal is kept
+    :param metrics   : (Metrics) collects the timings and counts of the renames, and decides whether
+                       messages are printed (see 'instrumentation'). If None, a new one is used
+
+    :return results : (list) the plan, with the status of every rename carried out set to 'renamed'
+                      (or 'failed', with the error). Collisions are reported, but left as they are
+    """
+
+    metrics = get_metrics(metrics)
+    for op in plan:
+        if op.status == 'collision':
+            metrics.count('errors')
+            metrics.event('could not rename {0} to {1}: {2}'.format(op.src, op.dst, op.error), level=logging.WARNING,
+                          path=op.src, new_path=op.dst, error=op.error)
+
+    steps = _rename_steps(plan)
+    done = []
+    undo_file = open(undo_path, 'a', encoding='utf-8') if undo_path is not None else None
+    try:
+        for src, dst in steps:
+            with metrics.timer('rename', src):
+                os.rename(src, dst)
+            done.append((src, dst))
+            if undo_file is not None:
+                undo_file.write(json.dumps({'src': str(src), 'dst': str(dst)}) + '\n')
+                undo_file.flush()
+    except OSError as e:
+        # Put back everything renamed so far, and mark the whole batch as failed
+        error = '{0}: {1}'.format(type(e).__name__, e)
+        metrics.count('errors')
+        metrics.event('could not rename {0} to {1}: {2}; reverting {3} renames'.format(src, dst, error, len(done)),
+                      level=logging.WARNING, path=src, new_path=dst, error=error)
+        rollback_errors = []
+        for src, dst in reversed(done):
+            try:
+                os.rename(dst, src)
+            except OSError as rollback_e:
+                rollback_error = '{0}: {1}'.format(type(rollback_e).__name__, rollback_e)
+                rollback_errors.append(rollback_error)
+                metrics.count('errors')
+                metrics.event('could not rename {0} back to {1}: {2}'.format(dst, src, rollback_error),
+                              level=logging.WARNING, path=dst, new_path=src, error=rollback_error)
+                continue
+            if undo_file is not None:
+                undo_file.write(json.dumps({'src': str(dst), 'dst': str(src)}) + '\n')
+        if len(rollback_errors) > 0:
+            if undo_file is not None:
+                undo_file.flush()
+            raise OSError('could not revert {0} of {1} renames after {2}: {3}'.format(
+                          len(rollback_errors), len(done), error, '; '.join(rollback_errors))) from e
+        return [op._replace(status='failed', error=error) if op.status in ('rename', 'cycle') else op for op in plan]
+    finally:
+        if undo_file is not None:
+            undo_file.close()
+
+    # Report the renames
+    results = []
+    for op in plan:
+        if op.status in ('rename', 'cycle'):
+            op = op._replace(status='renamed')
+            metrics.count('files renamed')
+            metrics.event('renamed {0} to {1}'.format(op.src, op.dst), path=op.src, new_path=op.dst)
+        results.append(op)
+
+    return results
+
+
+def report_plan(plan, metrics=None):
+
+    """
+    report_plan : reports what a rename plan would do, without doing anything (for dry runs)
+
+    :param plan    : (list) list of RenameOp, as returned by 'plan_renames'
+    :param metrics : (Metrics) decides whether messages are printed (see 'instrumentation').
+                     If None, a new one is used
+    """
+
+    metrics = get_metrics(metrics)
+    for op in plan:
+        if op.status in ('rename', 'cycle'):
+            metrics.event('would rename {0} to {1}'.format(op.src, op.dst), path=op.src, new_path=op.dst)
+        elif op.status == 'collision':
+            metrics.event('would not rename {0} to {1}: {2}'.format(op.src, op.dst, op.error), level=logging.WARNING,
+                          path=op.src, new_path=op.dst, error=op.error)
+
+
+def undo_renames(undo_path, metrics=None):
+
+    """
+    undo_renames : reverts all renames recorded in an undo journal (see 'apply_renames'), most recent
+                   first, and removes the journal afterwards
+
+    :param undo_path : (str) path of the undo journal
+    :param metrics   : (Metrics) collects the timings and counts of the renames, and decides whether
+                       messages are printed (see 'instrumentation'). If None, a new one is used
+    """
+
+    metrics = get_metrics(metrics)
+    with open(undo_path, encoding='utf-8') as f:
+        steps = [json.loads(line) for line in f if line.strip()]
+
+    for step in reversed(steps):
+        src, dst = pathlib.Path(step['src']), pathlib.Path(step['dst'])
+        with metrics.timer('rename', dst):
+            os.rename(dst, src)
+        metrics.event('renamed {0} back to {1}'.format(dst, src), path=dst, new_path=src)
+
+    os.remove(undo_path)
+    metrics.finish('undo_renames')
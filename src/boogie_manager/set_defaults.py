@@ -1,21 +1,40 @@
 # -*- coding: utf-8 -*-
 
 import getpass
-import pandas as pd
 import pathlib
 
+from .lazy_inputs import TagSchema, WordList
+
 inputs_folder = pathlib.Path(__file__).resolve().parent.parent.parent / 'inputs'
 
 username = getpass.getuser()
 ROOTFOLDER = pathlib.Path(r'C:/Users/{0}/Music'.format(username))
 
-FIELDNAMES = pd.read_csv(inputs_folder / 'fieldnames.csv', index_col=0, header=0, sep=';')
-TITLECASE_EN = tuple(pd.read_csv(inputs_folder / 'titlecase_words.csv', index_col=None, header=0)['word'])
+# Both are only read from disk the first time they are used (see 'lazy_inputs')
+FIELDNAMES = TagSchema(inputs_folder / 'fieldnames.csv', delimiter=';')
+TITLECASE_EN = WordList(inputs_folder / 'titlecase_words.csv', column='word')
 
 MIME_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.bmp': 'image/bmp'}
 MP4_COVERTYPES = {'.jpg': 'FORMAT_JPEG', '.jpeg': 'FORMAT_JPEG', '.png': 'FORMAT_PNG'}
 FILETYPES = {'.m4a': 'ALAC', '.mp3': 'MP3', '.flac': 'FLAC'}
 
+# Padding (in bytes) to reserve in the tags whenever a file has to be rewritten anyway,
+# so that later tag edits fit in place; and the minimum padding for a file to be considered
+# ready for a typical tag edit (see 'padding_policy' and 'audit_padding')
+PADDING_RESERVE = 64 * 1024
+PADDING_MIN = 4 * 1024
+
+# Maximum total size (in bytes) of the album cover images kept in memory by 'AlbumArtCache'
+ART_CACHE_BYTES = 128 * 1024 * 1024
+
+# Dimensions of the summed-length cube that reports and graphs are made from (see 'build_length_cube')
+LENGTH_CUBE_DIMS = ['year', 'genre level 1', 'genre level 2', 'genre level 3', 'source', 'File type', 'artist']
+
+# Columns of the library dataframe with few distinct values, stored as categoricals in the compact layout
+# (see 'compact_library_frame'); the derived columns are converted too if they are present
+CATEGORICAL_COLS = ['artist', 'album artist', 'sort artist', 'album', 'genre', 'comment', 'File type', 'source',
+                    'genre level 1', 'genre level 2', 'genre level 3', 'genre folder']
+
 # ================= Everything below this line is specific to author's library, probably not relevant for other users =================  
 
 SPLITFOLDER = '98 splits'
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+import pathlib
+import sys
+
+
+# Run the tests against the package in 'src' without installing it
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'src'))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from boogie_manager.base import AudioWrapper
+from boogie_manager.benchmarks import make_synthetic_file
+from boogie_manager.import_pipeline import import_download
+from boogie_manager.instrumentation import Metrics
+
+
+def test_file_without_title_is_kept_and_counted_once(tmp_path):
+
+    # One file with a title and one without, in a single album folder
+    album = tmp_path / 'Album'
+    make_synthetic_file(album / 'with title.mp3', {'title': 'Song', 'track': '1'})
+    make_synthetic_file(album / 'no title.flac', {'track': '2'})
+
+    steps = []
+    metrics = Metrics(quiet=True, progress=lambda done, total, path: steps.append((done, total)))
+    results = import_download(tmp_path, stages=('filenames',), metrics=metrics)
+
+    assert len(results) == 2
+    assert sorted(result.status for result in results) == ['unchanged', 'unchanged']
+    assert sorted(result.path.name for result in results) == ['Song.mp3', 'no title.flac']
+    assert sorted(path.name for path in album.iterdir()) == ['Song.mp3', 'no title.flac']
+    assert steps[-1] == (2, 2)
+    assert metrics.counters['errors'] == 0
+
+
+def test_mp4_titles_set_by_cleanup_are_used_for_the_filenames(tmp_path):
+
+    # MP4 titles are stored as lists; the filename must use the whole title, not just its first character
+    album = tmp_path / 'Album'
+    make_synthetic_file(album / '03-track.m4a', {'title': 'Old Title', 'track': '3'})
+    make_synthetic_file(album / 'Other Track.m4a', {'title': 'Old Title', 'track': '4'})
+
+    results = import_download(tmp_path, stages=('cleanup', 'filenames'), metrics=Metrics(quiet=True))
+
+    assert sorted(result.status for result in results) == ['saved', 'saved']
+    assert sorted(path.name for path in album.iterdir()) == ['03-track.m4a', 'Other Track.m4a']
+    assert {AudioWrapper(path).get_value('title') for path in album.iterdir()} == {'03-track', 'Other Track'}
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pathlib
+
+import pytest
+
+from boogie_manager.benchmarks import LIGHT_MODULES, import_time
+
+
+@pytest.mark.parametrize('module', LIGHT_MODULES)
+def test_light_modules_skip_heavy_imports(module, monkeypatch):
+
+    # The imports run in fresh interpreters, which need to find the package in 'src' as well
+    src = str(pathlib.Path(__file__).resolve().parent.parent / 'src')
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(filter(None, [src, os.environ.get('PYTHONPATH')])))
+
+    seconds, heavy = import_time(module, repeat=1)
+
+    assert seconds > 0
+    assert heavy == []
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import pathlib
+
+import pandas as pd
+import pytest
+
+from boogie_manager.benchmarks import make_synthetic_file, make_synthetic_library
+from boogie_manager.instrumentation import Metrics
+from boogie_manager.library_data import add_derived_cols, grab_all_music_files
+
+
+@pytest.mark.parametrize('path, genre_folder', [
+    ('01 metal/Artist/Album/t.mp3', '01 metal'),
+    ('01 metal/Artist/Album/Disc 2/t.mp3', '01 metal'),
+    ('Artist/Album/t.mp3', '.'),
+    ('Artist/Album/Disc 2/t.mp3', '.'),
+    ('Album/Disc 2/t.mp3', '.'),
+    ('t.mp3', '.'),
+])
+def test_genre_folder(path, genre_folder):
+
+    df = pd.DataFrame({'genre': ['01.02 doom'], 'comment': ['']}, index=[pathlib.Path(path)])
+
+    assert add_derived_cols(df)['genre folder'].iloc[0] == str(pathlib.Path(genre_folder))
+
+
+def test_journal_scan_keeps_the_row_order(tmp_path):
+
+    # After adding a file to one album, a rescan with the journal (where only that album's folder
+    # is listed again) gives exactly the same dataframe as a full scan
+    root = tmp_path / 'library'
+    make_synthetic_library(root, n_artists=4, albums_per_artist=2, tracks_per_album=3, cover_bytes=0)
+    index_path = tmp_path / 'index.sqlite'
+    grab_all_music_files(root, require_numeric=False, index_path=index_path, use_journal=True,
+                         metrics=Metrics(quiet=True))
+    album = sorted(root.glob('*/*/*/*'))[-1]
+    make_synthetic_file(album / '04 New Song.mp3', {'title': 'New Song', 'track': '4'})
+
+    df_full = grab_all_music_files(root, require_numeric=False, metrics=Metrics(quiet=True))
+    df_journal = grab_all_music_files(root, require_numeric=False, index_path=index_path, use_journal=True,
+                                      metrics=Metrics(quiet=True))
+
+    assert df_journal.attrs['scan_stats']['rescanned'] == 1
+    assert df_journal.equals(df_full)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from boogie_manager.batch_ops import titles2filenames
+from boogie_manager.benchmarks import make_synthetic_file
+from boogie_manager.instrumentation import Metrics
+from boogie_manager.rename_engine import apply_renames, plan_renames, undo_renames
+
+
+def _make_files(folder, names):
+
+    # Small text files whose contents are their original names, to check where each one ended up
+    folder.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        (folder / name).write_text(name)
+
+
+def _contents(folder):
+
+    # Maps each file name in the folder to its contents (i.e. its original name)
+    return {p.name: p.read_text() for p in folder.iterdir()}
+
+
+def test_swap(tmp_path):
+
+    _make_files(tmp_path, ['a', 'b'])
+    plan = plan_renames([(tmp_path / 'a', tmp_path / 'b'), (tmp_path / 'b', tmp_path / 'a')])
+    assert [op.status for op in plan] == ['cycle', 'cycle']
+
+    results = apply_renames(plan, metrics=Metrics(quiet=True))
+
+    assert [op.status for op in results] == ['renamed', 'renamed']
+    assert _contents(tmp_path) == {'a': 'b', 'b': 'a'}
+
+
+def test_chain(tmp_path):
+
+    # a -> b -> c -> d: 'c' has to move first, then 'b', then 'a'
+    _make_files(tmp_path, ['a', 'b', 'c'])
+    plan = plan_renames([(tmp_path / 'a', tmp_path / 'b'), (tmp_path / 'b', tmp_path / 'c'),
+                         (tmp_path / 'c', tmp_path / 'd')])
+    assert [op.status for op in plan] == ['rename', 'rename', 'rename']
+
+    apply_renames(plan, metrics=Metrics(quiet=True))
+
+    assert _contents(tmp_path) == {'b': 'a', 'c': 'b', 'd': 'c'}
+
+
+def test_collisions(tmp_path):
+
+    # One rename onto a file that stays where it is, and two renames onto the same new name
+    _make_files(tmp_path, ['a', 'b', 'c', 'd'])
+    plan = plan_renames([(tmp_path / 'a', tmp_path / 'b'), (tmp_path / 'c', tmp_path / 'e'),
+                         (tmp_path / 'd', tmp_path / 'e')])
+    assert [op.status for op in plan] == ['collision', 'collision', 'collision']
+
+    metrics = Metrics(quiet=True)
+    apply_renames(plan, metrics=metrics)
+
+    assert _contents(tmp_path) == {'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'}
+    assert metrics.counters['errors'] == 3
+
+
+def test_rollback(tmp_path, monkeypatch):
+
+    # The third rename fails, so the first two are reverted
+    _make_files(tmp_path, ['a', 'b', 'c'])
+    plan = plan_renames([(tmp_path / name, tmp_path / (name + '2')) for name in 'abc'])
+    undo_path = tmp_path.parent / 'undo.jsonl'
+    real_rename = os.rename
+    calls = []
+
+    def failing_rename(src, dst):
+        calls.append(src)
+        if len(calls) == 3:
+            raise OSError('disk full')
+        real_rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', failing_rename)
+    results = apply_renames(plan, undo_path, Metrics(quiet=True))
+
+    assert [op.status for op in results] == ['failed', 'failed', 'failed']
+    assert _contents(tmp_path) == {'a': 'a', 'b': 'b', 'c': 'c'}
+
+
+def test_failed_rollback_can_be_undone(tmp_path, monkeypatch):
+
+    # The third rename fails, and so does reverting the first one; the undo journal finishes the job
+    _make_files(tmp_path, ['a', 'b', 'c'])
+    plan = plan_renames([(tmp_path / name, tmp_path / (name + '2')) for name in 'abc'])
+    undo_path = tmp_path.parent / 'undo.jsonl'
+    real_rename = os.rename
+    calls = []
+
+    def failing_rename(src, dst):
+        calls.append(src)
+        if len(calls) in (3, 5):
+            raise OSError('disk full')
+        real_rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', failing_rename)
+    with pytest.raises(OSError):
+        apply_renames(plan, undo_path, Metrics(quiet=True))
+    monkeypatch.setattr(os, 'rename', real_rename)
+
+    assert _contents(tmp_path) == {'a2': 'a', 'b': 'b', 'c': 'c'}
+    undo_renames(undo_path, Metrics(quiet=True))
+    assert _contents(tmp_path) == {'a': 'a', 'b': 'b', 'c': 'c'}
+
+
+def test_failure_only_reverts_its_own_folder(tmp_path):
+
+    # A title too long for a filename fails in one album, but the other album is still renamed
+    make_synthetic_file(tmp_path / 'Album 1' / '01.mp3', {'title': 'Song', 'track': '1'})
+    make_synthetic_file(tmp_path / 'Album 1' / '02.mp3', {'title': 'x' * 300, 'track': '2'})
+    make_synthetic_file(tmp_path / 'Album 2' / '01.mp3', {'title': 'Other Song', 'track': '1'})
+
+    plan = titles2filenames(tmp_path, metrics=Metrics(quiet=True))
+
+    assert [op.status for op in plan] == ['failed', 'failed', 'renamed']
+    assert sorted(p.name for p in (tmp_path / 'Album 1').iterdir()) == ['01.mp3', '02.mp3']
+    assert sorted(p.name for p in (tmp_path / 'Album 2').iterdir()) == ['Other Song.mp3']